@@ -17,19 +17,48 @@ proc crc_shift {crcval} {
     return [expr {($crcval >> 1) ^ (-($crcval & 1) & 0x9fc)}]
 }
 
-# Pre-compute checksums for contiguous bit flips, which seems to be the most
-# common failure type.
+# crc_byte_tab(b) is b shifted through the crc 8 times.  The crc is linear and
+# the upper bits just move down, so 8 shifts of x are
+# (x >> 8) ^ crc_byte_tab(x & 0xff).
+set crc_byte_tab [list]
+proc crc_byte_setup {} {
+    global crc_byte_tab
+    set crc_byte_tab [list]
+    for {set b 0} {$b < 256} {incr b} {
+        set crcval $b
+        for {set i 0} {$i < 8} {incr i} {
+            set crcval [crc_shift $crcval]
+        }
+        lappend crc_byte_tab $crcval
+    }
+}
+
+# Shift the 32 nonce bits of a padded nonce through the crc.  Zero if the
+# checksum matches, otherwise the syndrome of the error.
+proc crc_syndrome {padded} {
+    global crc_byte_tab
+    set crcval $padded
+    for {set i 0} {$i < 4} {incr i} {
+        set crcval [expr {($crcval >> 8) ^ [lindex $crc_byte_tab [expr {$crcval & 0xff}]]}]
+    }
+    return $crcval
+}
+
+# Pre-compute corrections for the error patterns the checksum can identify,
+# as syndrome -> {correction class}.  Contiguous bit flips, which seem to be
+# the most common failure type, always have a syndrome of their own.  Two
+# separate bit flips are only corrected if no contiguous flip and no other
+# pair has the same syndrome, since otherwise we can't tell which happened.
 array set crc_correction_tab {}
 proc crc_setup {} {
     global crc_correction_tab
 
-    set mask 0x800
+    crc_byte_setup
+
     set masks [list]
-    for {set i 43} {$i >= 0} {incr i -1} {
-        lappend masks $mask
-        set mask [crc_shift $mask]
+    for {set i 0} {$i < 44} {incr i} {
+        lappend masks [crc_syndrome [expr {1 << $i}]]
     }
-    set masks [lreverse $masks]
 
     for {set i 0} {$i < 44} {incr i} {
         set correction 0
@@ -37,34 +66,65 @@ proc crc_setup {} {
         for {set j $i} {$j < 44} {incr j} {
             set mask [expr {$mask ^ [lindex $masks $j]}]
             set correction [expr {$correction | (1 << $j)}]
-            array set crc_correction_tab [list $mask $correction]
+            set class [expr {$j == $i ? "single" : "burst"}]
+            array set crc_correction_tab [list $mask [list $correction $class]]
+        }
+    }
+
+    set doubles [dict create]
+    for {set i 0} {$i < 44} {incr i} {
+        for {set j [expr {$i + 2}]} {$j < 44} {incr j} {
+            set mask [expr {[lindex $masks $i] ^ [lindex $masks $j]}]
+            dict lappend doubles $mask [expr {(1 << $i) | (1 << $j)}]
+        }
+    }
+    dict for {mask corrections} $doubles {
+        if {[llength $corrections] == 1 && ![info exists crc_correction_tab($mask)]} {
+            set crc_correction_tab($mask) [list [lindex $corrections 0] double]
         }
     }
 }
 
-proc crc_message {padded cksum recoverable} {
+# Checksum statistics since the last call to get_crc_stats
+# Recoveries are also counted by correction class.
+set crc_stats [dict create checked 0 recovered 0 failed 0 single 0 burst 0 double 0]
+
+proc get_crc_stats {} {
+    global crc_stats
+    set res $crc_stats
+    set crc_stats [dict create checked 0 recovered 0 failed 0 single 0 burst 0 double 0]
+    return $res
+}
+
+proc crc_message {padded cksum recoverable {class ""}} {
+    global crc_stats
     if {$recoverable} {
+        dict incr crc_stats recovered
+        dict incr crc_stats $class
         status_print -type warning "Recoverable checkcksum failure: $padded -> $cksum"
     } else {
+        dict incr crc_stats failed
         status_print -type error "Unrecoverable checkcksum failure: $padded -> $cksum"
     }
 }
 
 proc crc_check {padded} {
     global crc_correction_tab
+    global crc_stats
 
-    set cksum $padded
-    for {set i 0} {$i < 32} {incr i} {
-        set cksum [crc_shift $cksum]
-    }
+    dict incr crc_stats checked
+
+    set cksum [crc_syndrome $padded]
     # If everything went okay, cksum should be 0
     if {$cksum != 0} {
         # Try to recover
-        set item [array get crc_correction_tab $cksum]
-        set recoverable [expr {$item != ""}]
-        crc_message $padded $cksum $recoverable
+        set recoverable [info exists crc_correction_tab($cksum)]
         if {$recoverable} {
-            set padded [expr {$padded ^ [lindex $item 1]}]
+            lassign $crc_correction_tab($cksum) correction class
+            crc_message $padded $cksum 1 $class
+            set padded [expr {$padded ^ $correction}]
+        } else {
+            crc_message $padded $cksum 0
         }
     }
     return [expr {$padded & 0xffffffff}]
@@ -10,3 +10,10 @@ set config_mode solo
 
 # stdout mode 'brief' or 'verbose'
 set config_output brief
+
+# seconds between board statistics reports to the pool, 0 to disable
+set config_stats_interval 60
+
+# pool protocol framing 'text' or 'binary'.  Binary is used if the pool or
+# proxy agrees to it, otherwise the miner stays with text.
+set config_framing text
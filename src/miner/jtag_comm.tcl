@@ -46,30 +46,51 @@ proc identify_project {hardware_name} {
 
 # Initialize the FPGA
 proc fpga_init {hardware_name} {
+    global fpga_target
     set device_name [find_miner_fpga $hardware_name]
 
     if {$device_name eq ""} {
         return 0
     }
     start_insystem_source_probe -hardware_name $hardware_name -device_name $device_name
+    # a newly programmed design starts from its initial target
+    set fpga_target ""
     post_message -type info "Mining fpga found: $hardware_name $device_name"
     return 1
 }
 
 set fpga_current_work ""
 set fpga_last_nonce ""
-
-# Push new work to the FPGA
-proc push_work_to_fpga {work} {
+# set when the next nonce read may still be for the previous work
+set fpga_discard_nonce 0
+# target last written to the fpga
+set fpga_target ""
+
+# Push new work to the FPGA.  If fpga_order is set, the work is already in the
+# byte order the FPGA takes, which is the header reversed.
+proc push_work_to_fpga {work {fpga_order 0}} {
     global fpga_current_work
+    global fpga_discard_nonce
 
-    write_instance "WRK1" [reverse_hex [string range $work 0 71]]
-    write_instance "WRK2" [reverse_hex [string range $work 72 151]]
+    set header [string range $work 0 151]
+    if {!$fpga_order} {
+        set header [reverse_hex $header]
+    }
+    if {[instance_exists WORK]} {
+        # designs with one source for the whole header take it in one write
+        write_instance WORK $header
+    } else {
+        # WRK1 is the first 36 bytes of the header and WRK2 the rest, so
+        # reversed they are the end and the start of the reversed header
+        write_instance WRK1 [string range $header 80 151]
+        write_instance WRK2 [string range $header 0 79]
+    }
     set fpga_current_work [string range $work 0 151]
 
-    # Reset the last nonce.  This isn't strictly necessary, but prevents a race
-    # condition that would result in us occasionally submitting bad shares.
-    get_result_from_fpga
+    # Discard the next nonce read.  The previous work may have found it, and
+    # submitting it for this work would be a bad share.  Doing this on the
+    # next poll rather than now saves a JTAG round trip before hashing starts.
+    set fpga_discard_nonce 1
 }
 
 proc clear_fpga_work {} {
@@ -78,11 +99,13 @@ proc clear_fpga_work {} {
 }
 
 # Get a new result from the FPGA if one is available and format it for submission.
-# If no results are available, returns empty string
+# If no results are available, returns empty string.  The work is returned in
+# the byte order it was pushed in.
 proc get_result_from_fpga {} {
     global config_mode
     global fpga_last_nonce
     global fpga_current_work
+    global fpga_discard_nonce
 
     if {$fpga_current_work eq ""} {
         return
@@ -90,6 +113,11 @@ proc get_result_from_fpga {} {
 
     set golden_nonce [read_instance GNON]
 
+    if {$fpga_discard_nonce} {
+        set fpga_discard_nonce 0
+        set fpga_last_nonce $golden_nonce
+        return
+    }
     if {$golden_nonce ne $fpga_last_nonce} {
         set fpga_last_nonce $golden_nonce
         # see if it's padded with a checksum
@@ -106,6 +134,14 @@ proc get_result_from_fpga {} {
     }
 }
 
+# Get JTAG round trip statistics since the last call, and start over.
+proc get_jtag_stats {} {
+    global jtag_stats
+    set res $jtag_stats
+    set jtag_stats [dict create ops 0 total_us 0 max_us 0]
+    return $res
+}
+
 # Get the seed of the current design, if it reports it.
 proc get_fpga_seed {} {
     if {[instance_exists SEED]} {
@@ -113,12 +149,15 @@ proc get_fpga_seed {} {
     }
 }
 
-# Variable target mining is supported.
+# Variable target mining is supported.  The target rarely changes, so it is
+# only written when it does.
 proc set_work_target {target} {
+    global fpga_target
     # also support designs with hard-coded target
-    if {[instance_exists TRGT]} {
+    if {$target ne $fpga_target && [instance_exists TRGT]} {
         write_instance TRGT $target
     }
+    set fpga_target $target
 }
 
 # Ask the user which hardware to use
@@ -172,6 +211,7 @@ proc select_hardware {} {
 
 set fpga_instances [dict create]
 set fpga_last_nonce 0
+set jtag_stats [dict create ops 0 total_us 0 max_us 0]
 
 # Search the specified FPGA device for all Sources and Probes
 proc find_instances {hardware_name device_name} {
@@ -201,11 +241,27 @@ proc reverse_hex {hex_str} {
 }
 
 proc write_instance {name value} {
-    return [keep_trying 5 write_source_data -instance_index [instance_id $name] -value_in_hex -value $value]
+    set start [clock microseconds]
+    set res [keep_trying 5 write_source_data -instance_index [instance_id $name] -value_in_hex -value $value]
+    record_jtag_op $start
+    return $res
 }
 
 proc read_instance {name} {
-    return [keep_trying 5 read_probe_data -instance_index [instance_id $name] -value_in_hex]
+    set start [clock microseconds]
+    set res [keep_trying 5 read_probe_data -instance_index [instance_id $name] -value_in_hex]
+    record_jtag_op $start
+    return $res
+}
+
+proc record_jtag_op {start} {
+    global jtag_stats
+    set elapsed [expr {[clock microseconds] - $start}]
+    dict incr jtag_stats ops
+    dict incr jtag_stats total_us $elapsed
+    if {$elapsed > [dict get $jtag_stats max_us]} {
+        dict set jtag_stats max_us $elapsed
+    }
 }
 
 proc instance_exists {name} {
@@ -231,12 +287,13 @@ proc find_miner_fpga {hardware_name} {
 proc check_if_fpga_is_miner {hardware_name device_name} {
     find_instances $hardware_name $device_name
 
-    set expected [list WRK1 WRK2 GNON SEED]
+    set expected [list GNON SEED]
     foreach inst $expected {
         if {![instance_exists $inst]} {
             return 0
         }
     }
-    return 1
+    # the header is either one WORK source or split over WRK1 and WRK2
+    return [expr {[instance_exists WORK] || ([instance_exists WRK1] && [instance_exists WRK2])}]
 }
 
@@ -30,6 +30,39 @@ set last_warning ""
 set stratum_idstring ""
 set stratum_ntime ""
 set stratum_nonce2 ""
+# framing in use on the pool connection, 'text' until binary is acknowledged
+set framing text
+# received data not yet parsed in binary framing
+set rx_buffer ""
+# id of the current work in binary framing
+set work_id 0
+# when the message being handled arrived, and the time from work arriving to
+# the fpga hashing it for the current reporting interval
+set work_received [clock microseconds]
+set work_stats [dict create pushes 0 total_us 0 max_us 0]
+# board statistics for the current reporting interval
+set stats_start [clock milliseconds]
+set stats_shares 0
+set stats_work 0
+# expected number of hashes per share at the current target
+set share_work 0
+# why the fpga is not hashing ("work", "sof", "fpga" or "" if it is), and since when
+set idle_reason work
+set idle_since [clock milliseconds]
+set idle_time [dict create work 0 sof 0 fpga 0]
+
+# Account for time spent idle so far, then switch to the new idle reason
+proc set_idle {reason} {
+    global idle_reason
+    global idle_since
+    global idle_time
+    set now [clock milliseconds]
+    if {$idle_reason ne ""} {
+        dict incr idle_time $idle_reason [expr {$now - $idle_since}]
+    }
+    set idle_reason $reason
+    set idle_since $now
+}
 
 # change the epoch, and reprogram the fpga to the new seed
 proc advance_epoch {seed} {
@@ -40,6 +73,7 @@ proc advance_epoch {seed} {
     global hardware_name
     global project_config
     if {$seed == 0} {
+        set_idle work
         if {$seed != $last_warning} {
             status_print -type warning "Pool is unable to provide work."
             set last_warning $seed
@@ -56,6 +90,7 @@ proc advance_epoch {seed} {
     }
     set sof [get_sof_name [lindex $project_config 0] $seed]
     if {![file exists $sof]} {
+        set_idle sof
         if {$seed != $last_warning} {
             status_print -type warning "File $sof does not exist, unable to mine."
             post_message -type warning "Please ensure autocompile.sh is running."
@@ -64,6 +99,7 @@ proc advance_epoch {seed} {
         return 0
     }
     if {![program_fpga $hardware_name $sof [lindex $project_config 1]] || ![fpga_init $hardware_name]} {
+        set_idle fpga
         return 0
     }
     set last_seed $seed
@@ -71,9 +107,12 @@ proc advance_epoch {seed} {
     return 1
 }
 
-proc set_work {data target seed} {
+# fpga_order is set if the pool sent the header in the order the fpga takes it
+proc set_work {data target seed {fpga_order 0}} {
     global last_seed
     global last_warning
+    global share_work
+    global work_received
     if {$seed != $last_seed} {
         if {![advance_epoch $seed]} {
             clear_fpga_work
@@ -81,7 +120,10 @@ proc set_work {data target seed} {
         }
     }
     set_work_target $target
-    push_work_to_fpga $data
+    push_work_to_fpga $data $fpga_order
+    record_work_latency $work_received
+    set share_work [expr {2**256 / ("0x$target" + 1)}]
+    set_idle ""
     if {$last_warning == 0} {
         status_print -type info "Received work from pool."
         set last_warning ""
@@ -105,9 +147,9 @@ proc add_result {status} {
     global epoch_results
     dict incr epoch_results $status
     set count [dict get $epoch_results $status]
-    if {$status eq "accepted"} {
+    if {$status eq "accepted" || $status eq "pending"} {
         set type info
-    } elseif {$status eq "stale" || $status eq "inconclusive"} {
+    } elseif {$status eq "stale" || $status eq "duplicate" || $status eq "inconclusive"} {
         set type warning
     } else {
         set type error
@@ -132,12 +174,57 @@ proc add_result {status} {
 }
 
 proc receive_data {conn} {
+    global framing
+    global work_received
+    set work_received [clock microseconds]
+    if {$framing eq "binary"} {
+        receive_frames $conn
+        return
+    }
     fconfigure $conn -blocking 1
     gets $conn data
     if {$data eq ""} {
         status_print -type error "Lost connection to pool"
         qexit -error
     }
+    handle_line $conn $data
+    fconfigure $conn -blocking 0
+}
+
+# Parse as many frames as have arrived.  Each is a 2 byte length, covering
+# the type byte and payload, then a 1 byte type.
+proc receive_frames {conn} {
+    global rx_buffer
+    global work_id
+    append rx_buffer [read $conn]
+    if {[eof $conn]} {
+        status_print -type error "Lost connection to pool"
+        qexit -error
+    }
+    while {[binary scan $rx_buffer Sucu length type] == 2 && [string length $rx_buffer] >= $length + 2} {
+        if {$length < 1} {
+            # the length counts the type byte, so the stream can't be followed
+            status_print -type error "Invalid frame from pool"
+            qexit -error
+        }
+        set payload [string range $rx_buffer 3 [expr {$length + 1}]]
+        set rx_buffer [string range $rx_buffer [expr {$length + 2}] end]
+        if {$type == 0} {
+            # text line
+            handle_line $conn $payload
+        } elseif {($type == 1 || $type == 3) && [string length $payload] == 116
+                  && [binary scan $payload IuH152H64Iu id data target seed] == 4} {
+            # work <id> <data> <target> <seed>, type 3 has the header reversed
+            set work_id $id
+            set_work $data $target $seed [expr {$type == 3}]
+        } else {
+            status_print -type warning "Unknown frame type $type"
+        }
+    }
+}
+
+proc handle_line {conn data} {
+    global framing
     set args [split $data]
     set command [lindex $args 0]
     set args [lrange $args 1 end]
@@ -162,28 +249,112 @@ proc receive_data {conn} {
     } elseif {$command eq "reconnect"} {
         status_print -type info "reconnect request received, clear work"
         clear_fpga_work
+        set_idle work
+    } elseif {$data eq "framing binary" && $framing eq "text"} {
+        status_print -type info "using binary framing"
+        set framing binary
+        # ask for work that can be written to the fpga as it is
+        send_line $conn "work_order fpga"
+    } elseif {$data eq "work_order fpga"} {
+        status_print -type info "pool sends work in fpga byte order"
     } else {
         status_print -type warning "Unknown command: $command $args"
     }
+}
+
+# Send a frame of the given type, or a text line if type is 0 and binary
+# framing isn't in use
+proc send_frame {conn type payload} {
+    global framing
+    fconfigure $conn -blocking 1
+    if {$framing eq "binary"} {
+        puts -nonewline $conn [binary format Sc [expr {[string length $payload] + 1}] $type]$payload
+    } else {
+        puts $conn $payload
+    }
+    flush $conn
     fconfigure $conn -blocking 0
 }
 
+proc send_line {conn line} {
+    send_frame $conn 0 $line
+}
+
 proc submit_nonce {conn nonce} {
     global stratum_idstring
     global stratum_ntime
     global stratum_nonce2
+    send_line $conn "submit_nonce $nonce $stratum_idstring $stratum_ntime $stratum_nonce2"
+}
 
-    fconfigure $conn -blocking 1
-    puts $conn "submit_nonce $nonce $stratum_idstring $stratum_ntime $stratum_nonce2"
-    flush $conn
-    fconfigure $conn -blocking 0
+# Submit by work id.  The nonce is hex in header byte order.
+proc submit_frame {conn nonce} {
+    global work_id
+    send_frame $conn 2 [binary format IH8 $work_id $nonce]
+}
+
+proc record_share {} {
+    global stats_shares
+    global stats_work
+    global share_work
+    incr stats_shares
+    set stats_work [expr {$stats_work + $share_work}]
+}
+
+# Time from work arriving to the fpga hashing it
+proc record_work_latency {received} {
+    global work_stats
+    set elapsed [expr {[clock microseconds] - $received}]
+    dict incr work_stats pushes
+    dict incr work_stats total_us $elapsed
+    if {$elapsed > [dict get $work_stats max_us]} {
+        dict set work_stats max_us $elapsed
+    }
+}
+
+# Report board health to the pool, then schedule the next report
+proc send_stats {conn} {
+    global config_stats_interval
+    global stats_start
+    global stats_shares
+    global stats_work
+    global idle_reason
+    global idle_time
+    global work_stats
+
+    set_idle $idle_reason
+    set now [clock milliseconds]
+    set elapsed [expr {max(1, $now - $stats_start) / 1000.0}]
+    set jtag [get_jtag_stats]
+    set crc [get_crc_stats]
+    set ops [dict get $jtag ops]
+    set jtag_avg [expr {$ops ? [dict get $jtag total_us] / $ops : 0}]
+
+    set stats "stats interval=[format %.0f $elapsed]"
+    append stats " hashrate=[format %.0f [expr {double($stats_work) / $elapsed}]] shares=$stats_shares"
+    append stats " jtag_ops=$ops jtag_avg_us=$jtag_avg jtag_max_us=[dict get $jtag max_us]"
+    set pushes [dict get $work_stats pushes]
+    append stats " work_pushes=$pushes work_latency_avg_us=[expr {$pushes ? [dict get $work_stats total_us] / $pushes : 0}]"
+    append stats " work_latency_max_us=[dict get $work_stats max_us]"
+    dict for {key value} $crc {
+        append stats " crc_$key=$value"
+    }
+    dict for {key value} $idle_time {
+        append stats " idle_$key=[format %.1f [expr {$value / 1000.0}]]"
+    }
+
+    set stats_start $now
+    set stats_shares 0
+    set stats_work 0
+    set idle_time [dict create work 0 sof 0 fpga 0]
+    set work_stats [dict create pushes 0 total_us 0 max_us 0]
+
+    send_line $conn $stats
+    after [expr {$config_stats_interval * 1000}] [list send_stats $conn]
 }
 
 proc submit_work {conn work} {
-    fconfigure $conn -blocking 1
-    puts $conn "submit $work"
-    flush $conn
-    fconfigure $conn -blocking 0
+    send_line $conn "submit $work"
 }
 
 # Allow user to specify hardware via command line. Otherwise provide a list
@@ -211,6 +382,7 @@ proc create_pool_conn {} {
     global default_stratum_port
     global default_solo_port
     global config_mode
+    global config_framing
     if {$config_mode eq "stratum"} {
         set conn [socket $config_host $default_stratum_port]
     } else {
@@ -220,6 +392,10 @@ proc create_pool_conn {} {
     fconfigure $conn -buffering line
     fconfigure $conn -blocking 0
     fileevent $conn readable [list receive_data $conn]
+    if {$config_framing eq "binary"} {
+        # switch once the pool agrees
+        send_line $conn "framing binary"
+    }
     return $conn
 }
 
@@ -227,19 +403,22 @@ proc pool_auth {conn} {
     global miner_id
     # leave only numbers from miner_id
     regsub -all -- {[^0-9]} $miner_id "" worker
-    fconfigure $conn -blocking 1
-    puts $conn "auth $worker"
+    send_line $conn "auth $worker"
     status_print "auth request for worker $worker"
-    flush $conn
-    fconfigure $conn -blocking 0
 }
 
 proc wait_for_nonce {conn} {
     global config_mode
+    global framing
     while {1} {
         set solved_work [get_result_from_fpga]
         if {$solved_work ne ""} {
-            if {$config_mode eq "stratum"} {
+            record_share
+            if {$framing eq "binary" && $config_mode eq "stratum"} {
+                submit_frame $conn [reverse_hex $solved_work]
+            } elseif {$framing eq "binary"} {
+                submit_frame $conn [string range $solved_work 152 159]
+            } elseif {$config_mode eq "stratum"} {
                 submit_nonce $conn $solved_work
             } else {
                 submit_work $conn $solved_work
@@ -257,4 +436,7 @@ choose_hardware $argv
 #    set last_seed [get_fpga_seed]
 #}
 set conn [create_pool_conn]
+if {$config_stats_interval > 0} {
+    after [expr {$config_stats_interval * 1000}] [list send_stats $conn]
+}
 wait_for_nonce $conn
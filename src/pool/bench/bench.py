@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+# Benchmarks for the pool work generation and submission hot paths.
+# Copyright (C) 2019 MentalCollatz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import fnmatch
+import json
+import platform
+import socket
+import sys
+import threading
+import time
+from binascii import unhexlify
+
+import fixtures
+import header
+import pool
+from template import BlockTemplate, merkle_branch, rewards_for_miners
+
+try:
+    timer = time.perf_counter
+except AttributeError:
+    timer = time.time
+
+# Time fn, calibrating the number of calls per round so that each round takes
+# at least min_time seconds.  Returns per-call times in seconds.
+def measure(fn, repeat, min_time):
+    number = 1
+    while True:
+        start = timer()
+        for i in range(number):
+            fn()
+        elapsed = timer() - start
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed < min_time / 10 else 1 + int(min_time / max(elapsed, 1e-9))
+    rounds = [elapsed / number]
+    for r in range(repeat - 1):
+        start = timer()
+        for i in range(number):
+            fn()
+        rounds.append((timer() - start) / number)
+    rounds.sort()
+    return {"number": number, "best": rounds[0], "median": rounds[len(rounds) // 2]}
+
+def template_benchmarks(name, tpl, cbscript):
+    bt = BlockTemplate(tpl, cbscript)
+    templates.add(bt)
+    txids = [unhexlify(tx["txid"])[::-1] for tx in tpl["transactions"]]
+    return [
+        ("template_init/" + name, lambda: BlockTemplate(tpl, cbscript)),
+        ("get_work/" + name, lambda: bt.get_work(12345)),
+        ("get_data/" + name, lambda: bt.get_data(12345)),
+        ("merkle_branch/" + name, lambda: merkle_branch(list(txids))),
+        ("coinbase_data/" + name, lambda: bt.coinbase._data(12345, True)),
+        ("miner_submit/" + name, submit_benchmark(bt)),
+        ("miner_submit_binary/" + name, submit_benchmark(bt, binary=True)),
+    ]
+
+# Takes blocks without ever answering, as the real submitter answers later on
+# its own thread, so that only the pool's own work is timed
+class NullSubmitter:
+    def submit(self, data, callback):
+        pass
+
+templates = pool.TemplateRegistry(limit=1000)
+# The miners' manager is never started, so it doesn't send them work of its
+# own.  It holds every benchmark's template.
+manager = pool.Manager(fixtures.cbscript())
+manager.templates = templates
+# the pool's ends of the miners' connections are closed by close_miners
+connections = []
+
+# A miner connected over a socket pair, whatever the pool sends it being read
+# and thrown away
+def connect_miner():
+    conn, peer = socket.socketpair()
+    connections.append(peer)
+    def drain():
+        try:
+            while peer.recv(65536):
+                pass
+        except socket.error:
+            pass
+    thread = threading.Thread(target=drain)
+    thread.daemon = True
+    thread.start()
+    return pool.Miner(conn, ("bench", len(connections)), manager, NullSubmitter())
+
+# Disconnect the miners so that their threads finish
+def close_miners():
+    for peer in connections:
+        peer.shutdown(socket.SHUT_RDWR)
+        peer.close()
+
+# Miner.submit against a miner holding 100 work items, either as a text header
+# or a binary work id and nonce.  Only the lookup and block serialization are
+# timed.
+def submit_benchmark(bt, binary=False):
+    miner = connect_miner()
+    if binary:
+        miner.set_binary()
+    allocator = pool.ExtraNonceAllocator()
+    for i in range(100):
+        miner.push_work(bt, allocator.allocate())
+    if binary:
+        return lambda: miner.submit_id(0, b'\xde\xad\xbe\xef')
+    solved = bt.get_work(allocator.offset) + "deadbeef"
+    return lambda: miner.submit(solved)
+
+def stratum_benchmarks(name):
+    subscribe, notify = fixtures.stratum_notify(name)
+    enonce1, n2len = subscribe["result"][1], subscribe["result"][2]
+    params = notify["params"]
+    return [
+        ("get_params_header/" + name, lambda: header.get_params_header(params, enonce1, 1, n2len)),
+        ("swap_order/" + name, lambda: header.swap_order(params[1][::-1])),
+    ]
+
+def benchmarks():
+    cbscript = fixtures.cbscript()
+    res = []
+    for name, tpl in sorted(fixtures.templates().items()):
+        res += template_benchmarks(name, tpl, cbscript)
+    for name in sorted(fixtures.TEMPLATE_SIZES):
+        res += stratum_benchmarks(name)
+    res.append(("rewards_for_miners", lambda: rewards_for_miners(72000000000, cbscript)))
+    return res
+
+def compare(results, baseline_file, threshold):
+    with open(baseline_file) as f:
+        baseline = json.load(f)["benchmarks"]
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name in baseline:
+            ratio = result["best"] / baseline[name]["best"]
+            if ratio > threshold:
+                regressions.append(name)
+                print("REGRESSION %-40s %.2fx slower" % (name, ratio))
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pool hot paths.")
+    parser.add_argument("-f", "--filter", help="only run benchmarks matching this glob", default="*")
+    parser.add_argument("-r", "--repeat", help="rounds per benchmark", type=int, default=5)
+    parser.add_argument("-t", "--min-time", help="minimum seconds per round", type=float, default=0.1)
+    parser.add_argument("--json", help="write results to this file", type=str)
+    parser.add_argument("--compare", help="baseline json to compare against", type=str)
+    parser.add_argument("--threshold", help="slowdown ratio treated as a regression", type=float, default=1.2)
+    args = parser.parse_args()
+
+    results = {}
+    try:
+        for name, fn in benchmarks():
+            if not fnmatch.fnmatch(name, args.filter):
+                continue
+            results[name] = measure(fn, args.repeat, args.min_time)
+            print("%-40s %12.1fus %12.1fus  (x%d)" % (name, results[name]["best"] * 1e6,
+                results[name]["median"] * 1e6, results[name]["number"]))
+            sys.stdout.flush()
+    finally:
+        close_miners()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "time": int(time.time()),
+                "benchmarks": results,
+            }, f, indent=2, sort_keys=True)
+
+    if args.compare and compare(results, args.compare, args.threshold):
+        sys.exit(1)
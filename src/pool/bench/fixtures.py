@@ -0,0 +1,82 @@
+# Deterministic fixtures for the pool benchmarks.
+# Copyright (C) 2019 MentalCollatz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import random
+import sys
+
+here = os.path.dirname(os.path.abspath(__file__))
+for subdir in ["../solo", "../stratum", "../test"]:
+    sys.path.append(os.path.join(here, subdir))
+
+from fakenode import hex_str, make_template, random_bytes
+from template import Script
+
+# Fixed so that fixtures (and therefore timings) are reproducible
+FIXTURE_TIME = 1560000000
+FIXTURE_HEIGHT = 9112320
+
+TEMPLATE_SIZES = {
+    "small": 10,
+    "10k": 10000,
+}
+
+# Payout to a segwit address with a 2% donation to a legacy address, which is
+# what a typical pool.py invocation produces.
+def cbscript():
+    main = Script().push_int(0).push_bytes(b'\x11' * 20)
+    donation = Script()\
+        .push_byte(Script.OP_DUP)\
+        .push_byte(Script.OP_HASH160)\
+        .push_str(b'\x22' * 20)\
+        .push_byte(Script.OP_EQUALVERIFY)\
+        .push_byte(Script.OP_CHECKSIG)
+    return [(main.data, None), (donation.data, 0.02)]
+
+def template(size, segwit):
+    rng = random.Random("%s-%s" % (size, segwit))
+    prevhash = hex_str(random_bytes(rng, 32))
+    res = make_template(FIXTURE_HEIGHT, prevhash, TEMPLATE_SIZES[size], segwit, FIXTURE_TIME, rng)
+    res["coinbaseaux"]["cbstring"] = "/odo-miner-solo/"
+    return res
+
+# All combinations of mempool size and segwit, keyed by a short name
+def templates():
+    res = {}
+    for size in sorted(TEMPLATE_SIZES):
+        for segwit in [False, True]:
+            res["%s-%s" % (size, "segwit" if segwit else "legacy")] = template(size, segwit)
+    return res
+
+# A mining.notify message as sent by a typical stratum pool, together with the
+# mining.subscribe result that precedes it.
+def stratum_notify(size):
+    rng = random.Random("notify-%s" % size)
+    branch_len = max(1, TEMPLATE_SIZES[size].bit_length())
+    params = [
+        "%x" % rng.getrandbits(32),
+        hex_str(random_bytes(rng, 32)),
+        hex_str(random_bytes(rng, 42)),
+        hex_str(random_bytes(rng, 120)),
+        [hex_str(random_bytes(rng, 32)) for i in range(branch_len)],
+        "20000202",
+        "1e0fffff",
+        "%08x" % FIXTURE_TIME,
+        True,
+    ]
+    notify = {"id": None, "method": "mining.notify", "params": params}
+    subscribe = {"id": 0, "result": [[["mining.notify", "ae6812eb4cd7735a302a8a9dd95cf71f"]], "08000002", 4], "error": None}
+    return subscribe, notify
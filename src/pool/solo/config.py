@@ -22,6 +22,8 @@ import sys
 from template import Script
 
 DEFAULT_LISTEN_PORT = 17064
+# each worker gets its own top byte of the stratum extra nonce 1
+MAX_WORKERS = 256
 
 CHAIN_PARAMS = [
     {
@@ -67,12 +69,28 @@ def init(argv):
     parser.add_argument("-r", "--remote", help="allow remote miners to connect", action="store_true")
     parser.add_argument("--coinbase", help="coinbase string", type=str, default="/odo-miner-solo/")
     parser.add_argument("-d", "--donate", help="donation percentage", type=float, default=2.0)
+    parser.add_argument("-m", "--metrics", help="port to serve metrics on", dest="metrics_port", type=int)
+    parser.add_argument("-s", "--stratum", help="port to serve stratum clients on", dest="stratum_port", type=int)
+    parser.add_argument("--no-empty-work", help="wait for the full template on a new block instead of sending transaction-free work first", dest="empty_work", action="store_false")
+    parser.add_argument("-j", "--journal", help="file to record block candidates in until the node has accepted or rejected them")
+    parser.add_argument("--record", help="record templates, submission results and block notifications from the node to this file, for test/replay.py")
+    parser.add_argument("-w", "--workers", help="serve miners from this many worker processes sharing the listening port(s), with this process fetching templates and submitting blocks for them", type=int, default=0)
+    parser.add_argument("-z", "--zmq", help="node's zmqpubhashblock address, e.g. tcp://127.0.0.1:28332", dest="zmq_address")
     parser.add_argument("address", help="address to mine to", type=str)
     args = parser.parse_args(argv[1:])
 
     global params
-    params = {key: getattr(args, key) for key in ["rpc_host", "listen_port", "testnet"]}
-    
+    params = {key: getattr(args, key) for key in ["rpc_host", "listen_port", "testnet", "metrics_port", "stratum_port", "zmq_address", "empty_work", "journal", "record", "workers"]}
+    if args.workers < 0 or args.workers > MAX_WORKERS:
+        parser.error("--workers must be between 0 and %d" % MAX_WORKERS)
+    if args.workers and not hasattr(os, "fork"):
+        parser.error("--workers is not supported on this platform")
+    if args.zmq_address:
+        try:
+            import zmq
+        except ImportError:
+            parser.error("--zmq requires pyzmq (pip install pyzmq)")
+
     chain = CHAIN_PARAMS[args.testnet]
     cbscript = Script.from_address(args.address, **chain["addr_format"])
     if cbscript is None:
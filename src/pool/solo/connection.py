@@ -0,0 +1,89 @@
+# Copyright (C) 2019 MentalCollatz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Pieces shared by the servers miners connect to: the solo pool, its stratum
+# server and the stratum proxy.
+
+import socket
+import threading
+import time
+from collections import deque
+
+# Messages waiting to be written to a client by a thread of its own, so that
+# a slow client holds up nobody else.
+class Outbox:
+    def __init__(self, conn, delivery_seconds=None):
+        self.conn = conn
+        # histogram of the time from work falling due to it being written
+        self.delivery_seconds = delivery_seconds
+        # (data, time the work in it fell due or None)
+        self.queue = deque()
+        # Reentrant, so callers can hold it to queue a message and change how
+        # the next ones are encoded in one step.
+        self.cond = threading.Condition()
+        self.thread = None
+
+    # Queue data for writing.  Work replaces any work still waiting, which
+    # would be out of date by the time it was written.
+    def put(self, data, work_due=None):
+        with self.cond:
+            if work_due is not None:
+                kept = [item for item in self.queue if item[1] is None]
+                self.queue.clear()
+                self.queue.extend(kept)
+            self.queue.append((data, work_due))
+            self.cond.notify()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    # Stop the writer after what is already queued, and wait for it
+    def close(self):
+        self.put(None)
+        self.thread.join()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait()
+                data, work_due = self.queue.popleft()
+            if data is None:
+                break
+            try:
+                self.conn.sendall(data)
+            except socket.error as e:
+                # wake up the reader, which cleans up
+                try:
+                    self.conn.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+                break
+            if work_due is not None and self.delivery_seconds is not None:
+                self.delivery_seconds.observe(time.time() - work_due)
+
+# Board statistics, sent by the miner as "stats key=value ...", from the
+# arguments after "stats".  Values that aren't numbers are left out.
+def parse_stats(args):
+    stats = {}
+    for arg in args:
+        key, sep, value = arg.partition("=")
+        try:
+            stats[key] = float(value)
+        except ValueError:
+            pass
+    return stats
@@ -0,0 +1,126 @@
+# Copyright (C) 2019 MentalCollatz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Binary framing for the pool to miner protocol.
+#
+# A miner asks for it by sending the text line "framing binary".  A pool that
+# supports it answers with the same line, and every message after that, in
+# both directions, is a frame:
+#
+#   length  (2 bytes, big endian, counts the type byte and payload)
+#   type    (1 byte)
+#   payload
+#
+# FRAME_TEXT    a text protocol line without the newline, e.g. "result accepted"
+# FRAME_WORK    work id (4), header without nonce (76), target (32, big
+#               endian as in the text protocol), odo key (4)
+# FRAME_SUBMIT  work id (4), nonce (4, in header byte order)
+# FRAME_WORK_FPGA  as FRAME_WORK, with the header bytes reversed
+#
+# Integers are big endian.  Submissions refer to work by id instead of echoing
+# the header back.  A length of 0, or a payload of the wrong size for its
+# type, means the peer is broken and the connection should be dropped.
+#
+# Once binary framing is in use, the miner may also send "work_order fpga".  A
+# pool that supports it answers with the same line and sends FRAME_WORK_FPGA
+# instead of FRAME_WORK from then on.  The reversed header is the value the
+# FPGA's work sources take, so the miner can write it without reordering it.
+
+from binascii import hexlify, unhexlify
+import struct
+
+from template import as_str
+
+NEGOTIATE = "framing binary"
+
+FRAME_TEXT = 0
+FRAME_WORK = 1
+FRAME_SUBMIT = 2
+FRAME_WORK_FPGA = 3
+
+WORK_ORDER_FPGA = "work_order fpga"
+
+FRAME_HEADER = struct.Struct(">HB")
+WORK = struct.Struct(">I76s32sI")
+SUBMIT = struct.Struct(">I4s")
+
+def check_size(payload, layout):
+    if len(payload) != layout.size:
+        raise ValueError("payload is %d bytes, expected %d" % (len(payload), layout.size))
+
+def encode(frame_type, payload):
+    return FRAME_HEADER.pack(len(payload) + 1, frame_type) + payload
+
+def encode_text(line):
+    return encode(FRAME_TEXT, line.encode())
+
+def encode_work(work_id, header, target, key, fpga_order=False):
+    header = unhexlify(header[0:152])
+    if fpga_order:
+        return encode(FRAME_WORK_FPGA, WORK.pack(work_id, header[::-1], unhexlify(target), key))
+    return encode(FRAME_WORK, WORK.pack(work_id, header, unhexlify(target), key))
+
+# Returns (work id, header hex, target hex, odo key).  The header is put back
+# in header byte order if the frame has it reversed.
+def decode_work(payload, fpga_order=False):
+    check_size(payload, WORK)
+    work_id, header, target, key = WORK.unpack(payload)
+    if fpga_order:
+        header = header[::-1]
+    return work_id, as_str(hexlify(header)), as_str(hexlify(target)), key
+
+def encode_submit(work_id, nonce):
+    return encode(FRAME_SUBMIT, SUBMIT.pack(work_id, nonce))
+
+# Returns (work id, nonce bytes)
+def decode_submit(payload):
+    check_size(payload, SUBMIT)
+    return SUBMIT.unpack(payload)
+
+# Read one frame from a file-like object.  Returns (type, payload), or None
+# once the connection is closed or the peer sends an invalid length.
+def read_frame(f):
+    header = f.read(FRAME_HEADER.size)
+    if len(header) < FRAME_HEADER.size:
+        return None
+    length, frame_type = FRAME_HEADER.unpack(header)
+    if length < 1:
+        return None
+    payload = f.read(length - 1)
+    if len(payload) < length - 1:
+        return None
+    return frame_type, payload
+
+# Incremental decoder for event driven readers
+class FrameBuffer:
+    def __init__(self):
+        self.data = b''
+
+    # Add received data and return the complete frames as (type, payload).
+    # Raises ValueError on an invalid length, after which the stream can't be
+    # followed any further.
+    def feed(self, data):
+        self.data += data
+        frames = []
+        while len(self.data) >= FRAME_HEADER.size:
+            length, frame_type = FRAME_HEADER.unpack(self.data[0:FRAME_HEADER.size])
+            if length < 1:
+                raise ValueError("invalid frame length 0")
+            end = FRAME_HEADER.size + length - 1
+            if len(self.data) < end:
+                break
+            frames.append((frame_type, self.data[FRAME_HEADER.size:end]))
+            self.data = self.data[end:]
+        return frames
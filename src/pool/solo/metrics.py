@@ -0,0 +1,211 @@
+# Copyright (C) 2019 MentalCollatz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Minimal metrics in the Prometheus text exposition format.  Each metric has
+# its own lock which is only held long enough to update a number, so
+# instrumented code never waits on a scrape or on unrelated metrics.
+
+import bisect
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120)
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_labels(labelnames, key, extra=()):
+    pairs = list(zip(labelnames, key)) + list(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, escape(value)) for name, value in pairs)
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def exposition(self):
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines.append("# HELP %s %s" % (metric.name, metric.help))
+            lines.append("# TYPE %s %s" % (metric.name, metric.type))
+            lines += metric.samples()
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+        if registry is not None:
+            registry.register(self)
+
+    def key(self, labels):
+        return tuple(labels[name] for name in self.labelnames)
+
+    # Drop every child whose labels include the given ones
+    def remove(self, **labels):
+        match = [(self.labelnames.index(name), value) for name, value in labels.items()]
+        with self.lock:
+            for key in list(self.values):
+                if all(key[i] == value for i, value in match):
+                    del self.values[key]
+
+    def snapshot(self):
+        with self.lock:
+            return sorted(self.values.items())
+
+    def samples(self):
+        return ["%s%s %s" % (self.name, format_labels(self.labelnames, key), format_value(value))
+                for key, value in self.snapshot()]
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY):
+        Metric.__init__(self, name, help, labelnames, registry)
+        self.function = None
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    # Compute the value at scrape time instead.  The function returns either a
+    # number, or a list of (labels, value) pairs for labelled gauges.
+    def set_function(self, function):
+        self.function = function
+
+    def snapshot(self):
+        if self.function is None:
+            return Metric.snapshot(self)
+        res = self.function()
+        if not self.labelnames:
+            return [((), res)]
+        return sorted((self.key(labels), value) for labels, value in res)
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        Metric.__init__(self, name, help, labelnames, registry)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # per-bucket counts, then sum
+                counts = self.values[key] = [0] * len(self.buckets) + [0]
+            counts[i] += 1
+            counts[-1] += value
+
+    def time(self, **labels):
+        return Timer(self, labels)
+
+    def snapshot(self):
+        with self.lock:
+            return sorted((key, list(counts)) for key, counts in self.values.items())
+
+    def samples(self):
+        res = []
+        for key, counts in self.snapshot():
+            total = 0
+            for bound, count in zip(self.buckets, counts):
+                total += count
+                le = format_labels(self.labelnames, key, [("le", format_value(bound))])
+                res.append("%s_bucket%s %d" % (self.name, le, total))
+            labels = format_labels(self.labelnames, key)
+            res.append("%s_sum%s %s" % (self.name, labels, format_value(counts[-1])))
+            res.append("%s_count%s %d" % (self.name, labels, total))
+        return res
+
+# Context manager observing the duration of a block of code
+class Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.time() - self.start
+        self.histogram.observe(self.elapsed, **self.labels)
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.registry.exposition().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+# Serve /metrics from a background thread
+def serve(bind_addr, port, registry=REGISTRY):
+    server = MetricsServer((bind_addr, port), MetricsHandler)
+    server.registry = registry
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
@@ -15,24 +15,72 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import heapq
+import itertools
+import json
+import multiprocessing
+import os
 import random
+import signal
 import socket
+import struct
 import threading
 import time
+from binascii import hexlify, unhexlify
+from collections import OrderedDict
 
 import config
+import connection
+import framing
+import metrics
+import recorder
 import rpc
-from template import BlockTemplate
+import stratumserver
+import submitter
+from template import BlockTemplate, as_str
+
+LONGPOLL_SECONDS = metrics.Histogram("pool_getblocktemplate_seconds", "Time spent waiting for getblocktemplate, including longpoll.")
+TEMPLATE_BUILD_SECONDS = metrics.Histogram("pool_template_build_seconds", "Time to build a BlockTemplate.")
+PUSH_WORK_SECONDS = metrics.Histogram("pool_push_work_seconds", "Time to generate and queue work for all miners due for a refresh.")
+WORK_DELIVERY_SECONDS = metrics.Histogram("pool_work_delivery_seconds", "Time from work falling due to it being written to the miner's socket.")
+WORK_PUSHED = metrics.Counter("pool_work_pushed_total", "Work items sent to miners.")
+SUBMIT_RESULTS = metrics.Counter("pool_submit_total", "Submissions from miners by result.", ["result"])
+MINERS = metrics.Gauge("pool_miners", "Connected miners.")
+TEMPLATE_AGE = metrics.Gauge("pool_template_age_seconds", "Time since the current template was acquired.")
+MINER_HASHRATE = metrics.Gauge("pool_miner_hashrate", "Hashrate estimated from accepted shares and their target.", ["miner"])
+MINER_SHARES = metrics.Counter("pool_miner_shares_total", "Submissions per miner by result.", ["miner", "result"])
+BOARD_STATS = metrics.Gauge("pool_board_stat", "Latest statistics reported by each mining board.", ["miner", "stat"])
+BLOCK_NOTIFY_SECONDS = metrics.Histogram("pool_block_notify_to_work_seconds", "Time from a new block notification to work on the new tip being queued for miners.")
+NEW_TIP_SECONDS = metrics.Histogram("pool_new_tip_work_seconds", "Time from a template on a new tip arriving to work on it being queued for miners.")
+EMPTY_TEMPLATES = metrics.Counter("pool_empty_templates_total", "Transaction-free templates sent ahead of a full template on a new tip.")
+TEMPLATES = metrics.Gauge("pool_templates", "Block templates kept for outstanding work, including the current one.")
+TEMPLATE_BYTES = metrics.Gauge("pool_template_bytes", "Approximate memory held by the templates kept for outstanding work.")
+TEMPLATES_EVICTED = metrics.Counter("pool_templates_evicted_total", "Templates dropped to stay within the limit while work still referred to them.")
+BLOCK_NOTIFY_WINNER = metrics.Counter("pool_block_notify_total", "New block notifications by which fetch delivered the new tip first.", ["winner"])
+
+DEFAULT_REFRESH_INTERVAL = 10
+MIN_REFRESH_INTERVAL = 2
+MAX_REFRESH_INTERVAL = 60
+# shares needed before their rate is trusted for scheduling
+MIN_SCHEDULING_SHARES = 4
+# templates kept for outstanding work, and work items kept per miner
+MAX_TEMPLATES = 16
+MAX_WORK_ITEMS = 128
+
+def get_template(longpollid=None):
+    # copied rather than modified, the response may be being recorded
+    template = dict(rpc.get_block_template(longpollid))
+    template["coinbaseaux"] = dict(template.get("coinbaseaux") or {})
+    template["coinbaseaux"]["cbstring"] = config.get("cbstring")
+    return template
 
 def get_templates(callback):
     longpollid = None
     last_errno = None
     while True:
         try:
-            template = rpc.get_block_template(longpollid)
-            if "coinbaseaux" not in template:
-                template["coinbaseaux"] = {}
-            template["coinbaseaux"]["cbstring"] = config.get("cbstring")
+            with LONGPOLL_SECONDS.time():
+                template = get_template(longpollid)
             callback(template)
             longpollid = template["longpollid"]
             if last_errno != 0:
@@ -43,133 +91,793 @@ def get_templates(callback):
                 callback(None)
             if e.errno != last_errno:
                 last_errno = e.errno
-                print("%s: %s (errno %d)" % (time.asctime(), e.strerror, e.errno))
+                print("%s: %s (errno %s)" % (time.asctime(), e.strerror or e, e.errno))
             time.sleep(1)
 
+# Subscribe to the node's hashblock notifications (-zmqpubhashblock) and call
+# callback with each new tip's hash, in the byte order used by rpc.  This finds
+# out about blocks without waiting for the longpoll to return.
+def watch_blocks(address, callback):
+    import zmq
+    sock = zmq.Context.instance().socket(zmq.SUB)
+    sock.setsockopt(zmq.SUBSCRIBE, b"hashblock")
+    sock.connect(address)
+    while True:
+        msg = sock.recv_multipart()
+        if len(msg) >= 2 and msg[0] == b"hashblock" and len(msg[1]) == 32:
+            block_hash = as_str(hexlify(msg[1]))
+            recorder.record("hashblock", block_hash)
+            callback(block_hash)
+
+# Fetch a template right away, racing the longpoll that is already waiting
+def fetch_template(callback):
+    try:
+        callback(get_template())
+    except (rpc.RpcError, socket.error) as e:
+        print("%s: %s (errno %s)" % (time.asctime(), e.strerror or e, e.errno))
+
+# The template without its transactions.  It takes no time to build, so
+# miners can start on a new tip while the full template is being built.
+def empty_template(template):
+    res = dict(template)
+    res["transactions"] = []
+    res["coinbasevalue"] = template["coinbasevalue"] - sum(tx.get("fee", 0) for tx in template["transactions"])
+    return res
+
+# Hands out the extra nonces for a single template.  Each value in [start, stop)
+# is given out at most once, beginning at a random offset so that a template
+# that is refreshed unchanged does not repeat the previous one's work.  Miners
+# therefore never hash the same header.  Not thread safe, callers must hold the
+# manager's lock.
+class ExtraNonceAllocator:
+    def __init__(self, start=0, stop=2**30):
+        self.start = start
+        self.size = stop - start
+        self.offset = random.randrange(self.size)
+        self.allocated = 0
+
+    def allocate(self):
+        assert self.allocated < self.size, "extra nonce range exhausted"
+        res = self.start + (self.offset + self.allocated) % self.size
+        self.allocated += 1
+        return res
+
+# The templates outstanding work was made from, by id.  Work refers to its
+# template by id, and holds a reference counted by acquire and release, so the
+# registry holds the only lasting reference to a template other than the
+# manager's current one, and drops it along with the last work made from it.
+# Beyond MAX_TEMPLATES the oldest are dropped anyway, and any work still made
+# from them becomes stale.
+class TemplateRegistry:
+    def __init__(self, limit=MAX_TEMPLATES):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.ids = itertools.count()
+        # id -> [template, references], oldest first
+        self.templates = OrderedDict()
+
+    # Register a new template, holding one reference to it
+    def add(self, template):
+        with self.lock:
+            template.template_id = next(self.ids)
+            self.templates[template.template_id] = [template, 1]
+            while len(self.templates) > self.limit:
+                self.templates.popitem(last=False)
+                TEMPLATES_EVICTED.inc()
+
+    # Take a reference to a template.  Returns False if it has been dropped.
+    def acquire(self, template_id):
+        with self.lock:
+            entry = self.templates.get(template_id)
+            if entry is None:
+                return False
+            entry[1] += 1
+            return True
+
+    def release(self, template_id):
+        with self.lock:
+            entry = self.templates.get(template_id)
+            if entry is not None:
+                entry[1] -= 1
+                if entry[1] <= 0:
+                    del self.templates[template_id]
+
+    def get(self, template_id):
+        with self.lock:
+            entry = self.templates.get(template_id)
+        return entry[0] if entry is not None else None
+
+    def count(self):
+        return len(self.templates)
+
+    def footprint(self):
+        with self.lock:
+            templates = [entry[0] for entry in self.templates.values()]
+        return sum(template.footprint() for template in templates)
+
 class Manager(threading.Thread):
-    def __init__(self, cbscript):
+    def __init__(self, cbscript, empty_work=True, extra_nonce_range=(0, 2**30)):
         threading.Thread.__init__(self)
         self.cbscript = cbscript
+        self.empty_work = empty_work
+        # the extra nonces this manager's work may use, [start, stop)
+        self.extra_nonce_range = extra_nonce_range
         self.template = None
-        self.miners = []
+        self.templates = TemplateRegistry()
+        self.longpollid = None
+        # serializes template building, which happens outside cond
+        self.build_lock = threading.Lock()
+        # (previous block hash, arrival time) of a template on a new tip that
+        # no work has been sent for yet
+        self.new_tip = None
+        self.extra_nonces = ExtraNonceAllocator(*self.extra_nonce_range)
+        self.template_time = None
+        # (block hash, time) of a notified block whose template hasn't been
+        # sent yet, and which fetch got that template first
+        self.notified_block = None
+        self.notify_winner = None
+        # Previous block hash a template must have after a block has been
+        # announced, until one does.  Work from any other template would be
+        # stale, so none is given out.
+        self.awaited_tip = None
+        self.miners = set()
+        # heap of (refresh time, sequence, miner).  Entries whose time no longer
+        # matches the miner's next_refresh are left in place and skipped.
+        self.schedule = []
+        self.sequence = itertools.count()
         self.cond = threading.Condition()
 
+    def schedule_refresh(self, miner, when):
+        miner.next_refresh = when
+        heapq.heappush(self.schedule, (when, next(self.sequence), miner))
+
     def add_miner(self, miner):
         with self.cond:
-            self.miners.append(miner)
+            self.miners.add(miner)
+            self.schedule_refresh(miner, 0)
             self.cond.notify()
 
+    # Give the miner new work as soon as possible
+    def refresh_miner(self, miner):
+        with self.cond:
+            if miner in self.miners:
+                self.schedule_refresh(miner, 0)
+                self.cond.notify()
+
     def remove_miner(self, miner):
         with self.cond:
-            self.miners.remove(miner)
+            self.miners.discard(miner)
+            miner.next_refresh = None
+
+    # Hash of the block the current template builds on, as rpc shows it
+    def current_tip(self):
+        if self.template is None:
+            return None
+        return as_str(hexlify(self.template.previous_block_hash[::-1]))
 
-    def push_template(self, template):
+    # A new block was announced.  Work on its parent is stale from now on, so
+    # drop it and return True if a template for it should be fetched.
+    def new_block(self, block_hash):
         with self.cond:
-            if template is None:
-                self.template = None
-            else:
-                self.template = BlockTemplate(template, self.cbscript)
+            if self.current_tip() == block_hash:
+                BLOCK_NOTIFY_WINNER.inc(winner="longpoll")
+                return False
+            self.notified_block = (block_hash, time.time())
+            self.notify_winner = None
+            self.awaited_tip = unhexlify(block_hash)[::-1]
+            miners = list(self.miners)
+        for miner in miners:
+            miner.drop_work()
+        return True
+
+    # source is the fetch that produced the template, "longpoll" or "zmq"
+    def push_template(self, template, source="longpoll"):
+        if template is None:
+            self.set_template(None)
+            return
+        with self.build_lock:
+            with self.cond:
+                # the longpoll and a notification fetch often return the same thing
+                if self.template is not None and template.get("longpollid") == self.longpollid:
+                    return
+                if self.notified_block is not None and self.notify_winner is None \
+                        and template["previousblockhash"] == self.notified_block[0]:
+                    self.notify_winner = source
+                # A fetch made after the notification has the node's current
+                # tip, even if the announced block didn't stay on it.
+                if source == "zmq" and self.awaited_tip is not None:
+                    self.awaited_tip = unhexlify(template["previousblockhash"])[::-1]
+                new_tip = template["previousblockhash"] != self.current_tip()
+                if new_tip:
+                    self.new_tip = (unhexlify(template["previousblockhash"])[::-1], time.time())
+            if new_tip and self.empty_work and template["transactions"]:
+                self.set_template(BlockTemplate(empty_template(template), self.cbscript))
+                EMPTY_TEMPLATES.inc()
+            with TEMPLATE_BUILD_SECONDS.time():
+                block_template = BlockTemplate(template, self.cbscript)
+            self.set_template(block_template, template.get("longpollid"))
+
+    def set_template(self, template, longpollid=None):
+        if template is not None:
+            self.templates.add(template)
+        with self.cond:
+            # miners hold their own references to the old template
+            if self.template is not None:
+                self.templates.release(self.template.template_id)
+            self.template = template
+            self.longpollid = longpollid
+            if template is None or template.previous_block_hash == self.awaited_tip:
+                self.awaited_tip = None
+            self.extra_nonces = ExtraNonceAllocator(*self.extra_nonce_range)
+            self.template_time = time.time()
+            # everyone needs new work now
+            self.schedule = []
             for miner in self.miners:
-                miner.next_refresh = 0
+                self.schedule_refresh(miner, 0)
             self.cond.notify()
 
+    # Whether work from template would be stale because a block on another
+    # tip has been announced
+    def stale_template(self, template):
+        awaited_tip = self.awaited_tip
+        return awaited_tip is not None and template.previous_block_hash != awaited_tip
+
+    # Pop the miners that are due for new work and reschedule them.  Must be
+    # called with the lock held.
+    def due_miners(self, now):
+        res = []
+        while self.schedule and self.schedule[0][0] <= now:
+            when, sequence, miner = heapq.heappop(self.schedule)
+            if when != miner.next_refresh:
+                continue
+            res.append((miner, self.extra_nonces.allocate()))
+            self.schedule_refresh(miner, now + miner.refresh_interval())
+        return res
+
     def run(self):
         while True:
             with self.cond:
                 now = time.time()
-                next_refresh = now + 1000
-                for miner in self.miners:
-                    if miner.next_refresh < now:
-                        extra_nonce = random.randrange(2**30)
-                        miner.push_work(self.template, extra_nonce)
-                    next_refresh = min(next_refresh, miner.next_refresh)
-                wait_time = max(0, next_refresh - time.time())
-                self.cond.wait(wait_time)
+                template = self.template
+                if template is not None and self.stale_template(template):
+                    # set_template wakes us with the template on the new tip
+                    self.cond.wait()
+                    continue
+                due = self.due_miners(now)
+                if not due:
+                    self.cond.wait(self.schedule[0][0] - now if self.schedule else None)
+                    continue
+                notified = None
+                if self.notify_winner is not None:
+                    notified, winner = self.notified_block, self.notify_winner
+                    self.notified_block = self.notify_winner = None
+                new_tip = None
+                if self.new_tip is not None and template is not None \
+                        and template.previous_block_hash == self.new_tip[0]:
+                    new_tip, self.new_tip = self.new_tip, None
+            # Generating work happens outside the lock, and push_work only
+            # queues it, so a slow miner can't hold up anyone else.
+            for miner, extra_nonce in due:
+                miner.push_work(template, extra_nonce, now)
+            PUSH_WORK_SECONDS.observe(time.time() - now)
+            WORK_PUSHED.inc(len(due))
+            if new_tip is not None:
+                NEW_TIP_SECONDS.observe(time.time() - new_tip[1])
+            if notified is not None:
+                BLOCK_NOTIFY_SECONDS.observe(time.time() - notified[1])
+                BLOCK_NOTIFY_WINNER.inc(winner=winner)
+
+    def template_age(self):
+        if self.template_time is None:
+            return 0
+        return time.time() - self.template_time
+
+    # The connected miners, leaving out the stratum server
+    def connected_miners(self):
+        with self.cond:
+            return [miner for miner in self.miners if isinstance(miner, Miner)]
+
+    def hashrates(self):
+        return [({"miner": miner.peer}, miner.hashrate()) for miner in self.connected_miners()]
+
+    def board_stats(self):
+        miners = self.connected_miners()
+        return [({"miner": miner.peer, "stat": key}, value)
+                for miner in miners for key, value in miner.stats.items()]
 
 class Miner(threading.Thread):
-    def __init__(self, conn, manager):
+    def __init__(self, conn, addr, manager, submitter):
         threading.Thread.__init__(self)
         self.conn = conn
         self.manager = manager
+        self.submitter = submitter
+        self.closed = False
+        # from accept, getpeername fails if the miner has already reset
+        self.peer = "%s:%d" % addr[0:2]
+        self.connected = time.time()
+        self.accepted_work = 0
+        self.submitted_work = 0
+        self.submitted_shares = 0
+        self.stats = {}
         self.lock = threading.Lock()
-        self.conn_lock = threading.Lock()
-        self.work_items = []
+        self.outbox = connection.Outbox(conn, WORK_DELIVERY_SECONDS)
+        # merkle root -> (header hex without nonce, template id, extra nonce,
+        # work id), oldest first.  Each holds a reference to its template.
+        self.work_items = OrderedDict()
+        # work id -> merkle root, for binary submissions
+        self.work_ids = {}
+        self.next_work_id = 0
+        # id and previous block hash of the template work was last made from
+        self.work_template = None
+        self.work_tip = None
+        # whether the miner negotiated binary framing
+        self.binary = False
+        # whether work frames carry the header in the order the fpga takes it
+        self.fpga_order = False
         self.next_refresh = 0
-        self.refresh_interval = 10
         manager.add_miner(self)
         self.start()
 
-    def push_work(self, template, extra_nonce):
+    # Refresh often enough that the miner never runs out of nonces, judging its
+    # hashrate by the shares it submits or by what the board reports.
+    def refresh_interval(self):
+        hashrate = self.stats.get("hashrate", 0)
+        if self.submitted_shares >= MIN_SCHEDULING_SHARES:
+            hashrate = max(hashrate, self.submitted_work / max(1.0, time.time() - self.connected))
+        if hashrate <= 0:
+            return DEFAULT_REFRESH_INTERVAL
+        return min(MAX_REFRESH_INTERVAL, max(MIN_REFRESH_INTERVAL, 2**31 / hashrate))
+
+    def push_work(self, template, extra_nonce, due=None):
+        templates = self.manager.templates
         if template is None:
             workstr = "work %s %s %d" % ("0"*64, "0"*64, 0)
+            frame = None
+        elif not templates.acquire(template.template_id):
+            # already replaced, and new work is due straight away
+            return
         else:
             work = template.get_work(extra_nonce)
             workstr = "work %s %s %d" % (work, template.target, template.odo_key)
+        released = []
         with self.lock:
-            if template is None:
-                self.work_items = []
+            # The miner has gone and won't release anything from now on, or
+            # a block has been announced since the manager made this work.
+            # The announcement is followed by drop_work, which takes the lock,
+            # so work added before this check is dropped anyway.
+            if self.closed or (template is not None and self.manager.stale_template(template)):
+                if template is not None:
+                    templates.release(template.template_id)
+                return
+            # Losing the node doesn't make outstanding work stale, so it is
+            # kept until there is a template again.
+            if template is not None and template.template_id != self.work_template:
+                # Work for the previous template can still produce a valid
+                # block if it builds on the same tip, anything older is stale.
+                same_tip = self.work_tip == template.previous_block_hash
+                for key, item in list(self.work_items.items()):
+                    if not same_tip or item[1] != self.work_template:
+                        released.append(self.work_items.pop(key))
+                self.work_ids = dict((item[3], key) for key, item in self.work_items.items())
+                self.work_template = template.template_id
+                self.work_tip = template.previous_block_hash
+            if template is not None:
+                work_id = self.next_work_id
+                self.next_work_id = (work_id + 1) & 0xffffffff
+                key = unhexlify(work[72:136])
+                self.work_items[key] = (work[0:152], template.template_id, extra_nonce, work_id)
+                self.work_ids[work_id] = key
+                while len(self.work_items) > MAX_WORK_ITEMS:
+                    item = self.work_items.popitem(last=False)[1]
+                    self.work_ids.pop(item[3], None)
+                    released.append(item)
+        for item in released:
+            templates.release(item[1])
+        if template is not None:
+            frame = framing.encode_work(work_id, work, template.target, template.odo_key, self.fpga_order)
+        self.send(workstr, due or time.time(), frame)
+
+    # Forget outstanding work, which can no longer produce a block
+    def drop_work(self):
+        with self.lock:
+            released = list(self.work_items.values())
+            self.work_items = OrderedDict()
+            self.work_ids = {}
+        for item in released:
+            self.manager.templates.release(item[1])
+
+    # Queue a message for the writer thread.  Work that hasn't been sent yet is
+    # dropped when newer work arrives, since it would be stale anyway.  The
+    # message is encoded here, under the lock, so that nothing queued before
+    # the framing changes is sent in the new framing.  frame is the binary
+    # encoding of s if it has one other than a text frame.
+    def send(self, s, work_due=None, frame=None):
+        with self.outbox.cond:
+            if self.binary:
+                data = frame or framing.encode_text(s)
             else:
-                self.work_items.insert(0, (work, template, extra_nonce))
-                if len(self.work_items) > 2:
-                    self.work_items.pop()
-            self.next_refresh = time.time() + self.refresh_interval
-        try:
-            self.send(workstr)
-        except socket.error as e:
-            # let the other thread clean it up
-            pass
+                data = (s + "\n").encode()
+            self.outbox.put(data, work_due)
 
-    def send(self, s):
-        with self.conn_lock:
-            self.conn.sendall((s + "\n").encode())
+    # Acknowledge in text, then switch to binary framing.  Work already sent
+    # as text doesn't tell the miner its id, so follow up with new work.
+    def set_binary(self):
+        with self.outbox.cond:
+            self.send(framing.NEGOTIATE)
+            self.binary = True
+        self.manager.refresh_miner(self)
 
+    def hashrate(self):
+        return self.accepted_work / max(1.0, time.time() - self.connected)
+
+    def count_result(self, result):
+        SUBMIT_RESULTS.inc(result=result)
+        if not self.closed:
+            MINER_SHARES.inc(miner=self.peer, result=result)
+        return result
+
+    # Submit a solved header in hex, as sent in the text protocol.  Returns
+    # "pending" once it is queued, and the node's verdict follows when known.
     def submit(self, work):
-        with self.lock:
-            for work_item in self.work_items:
-                if work_item[0][0:152] == work[0:152]:
-                    template = work_item[1]
-                    extra_nonce = work_item[2]
-                    submit_data = work + template.get_data(extra_nonce)
-                    break
-            else:
-                return "stale"
         try:
-            return rpc.submit_work(submit_data)
-        except (rpc.RpcError, socket.error) as e:
-            print("failed to submit: %s (errno %d)" % (e.strerror, e.errno));
-            return "error"
+            key = unhexlify(work[72:136])
+        except (TypeError, ValueError):
+            return self.count_result("stale")
+        with self.lock:
+            work_item = self.work_items.get(key)
+        if work_item is None or work_item[0] != work[0:152]:
+            return self.count_result("stale")
+        return self.submit_item(work_item, work[152:160])
+
+    # Submit a nonce for the work with the given id, as sent in binary framing
+    def submit_id(self, work_id, nonce):
+        with self.lock:
+            work_item = self.work_items.get(self.work_ids.get(work_id))
+        if work_item is None:
+            return self.count_result("stale")
+        return self.submit_item(work_item, as_str(hexlify(nonce)))
+
+    def submit_item(self, work_item, nonce):
+        header, template_id, extra_nonce, work_id = work_item
+        template = self.manager.templates.get(template_id)
+        if template is None:
+            return self.count_result("stale")
+        work_per_share = template.work_per_share
+        self.submitted_shares += 1
+        self.submitted_work += work_per_share
+        submit_data = header + nonce + template.get_data(extra_nonce)
+        self.submitter.submit(submit_data, lambda result: self.submitted(work_per_share, result))
+        return "pending"
+
+    # Called from a submitter thread with the node's verdict
+    def submitted(self, work_per_share, result):
+        if result == "accepted":
+            self.accepted_work += work_per_share
+        self.count_result(result)
+        self.send("result %s" % result)
+
+    # Board statistics, sent by the miner as "stats key=value ..."
+    def set_stats(self, args):
+        self.stats = connection.parse_stats(args)
+
+    def handle_line(self, data):
+        parts = data.split()
+        if not parts:
+            return
+        command, args = parts[0], parts[1:]
+        if command == "submit" and len(args) == 1:
+            result = self.submit(*args)
+            self.send("result %s" % result)
+        elif command == "stats":
+            self.set_stats(args)
+        elif data == framing.NEGOTIATE and not self.binary:
+            self.set_binary()
+        elif data == framing.WORK_ORDER_FPGA and self.binary:
+            self.send(framing.WORK_ORDER_FPGA)
+            self.fpga_order = True
+        else:
+            print("unknown command: %s" % data)
+
+    def handle_frame(self, frame_type, payload):
+        if frame_type == framing.FRAME_SUBMIT:
+            result = self.submit_id(*framing.decode_submit(payload))
+            self.send("result %s" % result)
+        elif frame_type == framing.FRAME_TEXT and payload:
+            self.handle_line(as_str(payload))
+        else:
+            print("unknown frame type: %d" % frame_type)
 
     def run(self):
+        self.outbox.start()
+        reader = self.conn.makefile("rb")
         while True:
             try:
-                data = self.conn.makefile().readline().rstrip()
-                if not data:
-                    break
-                parts = data.split()
-                command, args = parts[0], parts[1:]
-                if command == "submit" and len(args) == 1:
-                    result = self.submit(*args)
-                    self.send("result %s" % result)
+                if self.binary:
+                    frame = framing.read_frame(reader)
+                    if frame is None:
+                        break
+                    self.handle_frame(*frame)
                 else:
-                    print("unknown command: %s" % data)
+                    data = as_str(reader.readline()).rstrip()
+                    if not data:
+                        break
+                    self.handle_line(data)
             except socket.error as e:
                 break
+            except (struct.error, ValueError) as e:
+                print("%s: protocol error from %s: %s" % (time.asctime(), self.peer, e))
+                break
+        self.closed = True
         self.manager.remove_miner(self)
+        self.drop_work()
+        MINER_SHARES.remove(miner=self.peer)
+        self.outbox.close()
+        reader.close()
         self.conn.close()
 
-if __name__ == "__main__":
+def listen(port, reuse_port=False):
     listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    listener.bind((config.get("bind_addr"), config.get("listen_port")))
-    listener.listen(10)
+    if reuse_port:
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    listener.bind((config.get("bind_addr"), port))
+    listener.listen(socket.SOMAXCONN)
+    return listener
+
+# Keep target supplied with templates from the node.  target is a Manager or,
+# in cluster mode, the Coordinator.
+def follow_node(target):
+    threading.Thread(target=get_templates, args=(target.push_template,)).start()
 
-    manager = Manager(config.get("cbscript"))
+    if config.get("zmq_address"):
+        def on_block(block_hash):
+            if target.new_block(block_hash):
+                callback = lambda t: target.push_template(t, "zmq")
+                threading.Thread(target=fetch_template, args=(callback,)).start()
+        watcher = threading.Thread(target=watch_blocks, args=(config.get("zmq_address"), on_block))
+        watcher.daemon = True
+        watcher.start()
+
+# Give miners, and stratum clients if there is a stratum listener, work from
+# manager.  Never returns.
+def serve_miners(manager, block_submitter, listener, stratum_listener=None, metrics_port=None, extra_nonce1_start=0):
     manager.start()
 
-    callback = lambda t: manager.push_template(t)
-    threading.Thread(target=get_templates, args=(callback,)).start()
+    MINERS.set_function(lambda: len(manager.connected_miners()))
+    TEMPLATES.set_function(manager.templates.count)
+    TEMPLATE_BYTES.set_function(manager.templates.footprint)
+    TEMPLATE_AGE.set_function(manager.template_age)
+    MINER_HASHRATE.set_function(manager.hashrates)
+    BOARD_STATS.set_function(manager.board_stats)
+    if metrics_port:
+        metrics.serve(config.get("bind_addr"), metrics_port)
+
+    if stratum_listener is not None:
+        stratum_server = stratumserver.StratumServer(stratum_listener, manager, block_submitter, extra_nonce1_start)
+        stratumserver.STRATUM_CLIENTS.set_function(stratum_server.client_count)
+        stratum_server.start()
 
     while True:
-        conn, addr = listener.accept()
-        Miner(conn, manager)
+        try:
+            conn, addr = listener.accept()
+        except socket.error as e:
+            # e.g. out of file descriptors, don't spin until some are freed
+            print("%s: accept failed: %s (errno %s)" % (time.asctime(), e.strerror or e, e.errno))
+            time.sleep(1)
+            continue
+        Miner(conn, addr, manager, block_submitter)
+
+# Cluster mode (--workers) spreads the miners over worker processes, each with
+# its own Manager, so that work generation and socket io aren't limited to one
+# core.  The coordinator process talks to the node: it sends every template to
+# the workers, serialized once, and submits the blocks they find.  Workers
+# listen on the same ports with SO_REUSEPORT, so the kernel shares out the
+# connections, and each has its own slice of the extra nonces so that no two
+# hand out the same work.
+
+# One end of a pipe between the coordinator and a worker, carrying json
+# messages:
+#
+#   template  [template, source]   coordinator to worker, template may be null
+#   block     [block hash]         coordinator to worker, from --zmq
+#   submit    [id, block data]     worker to coordinator
+#   result    [id, verdict]        coordinator to worker
+class Link:
+    def __init__(self, conn):
+        self.conn = conn
+        # sends come from several threads
+        self.lock = threading.Lock()
+
+    def send_data(self, data):
+        with self.lock:
+            self.conn.send_bytes(data)
+
+    def send(self, *msg):
+        self.send_data(json.dumps(msg).encode())
+
+    # Raises EOFError once the other end has gone
+    def recv(self):
+        return json.loads(self.conn.recv_bytes().decode())
+
+# Stands in for the Submitter in a worker, passing candidates to the
+# coordinator's and its verdicts back
+class RemoteSubmitter:
+    def __init__(self, link):
+        self.link = link
+        self.lock = threading.Lock()
+        self.ids = itertools.count()
+        # candidate id -> callback
+        self.callbacks = {}
+
+    def submit(self, data, callback):
+        with self.lock:
+            candidate_id = next(self.ids)
+            self.callbacks[candidate_id] = callback
+        try:
+            self.link.send("submit", candidate_id, data)
+        except (IOError, OSError):
+            self.finish(candidate_id, "error")
+
+    def finish(self, candidate_id, result):
+        with self.lock:
+            callback = self.callbacks.pop(candidate_id, None)
+        if callback is not None:
+            callback(result)
+
+class Coordinator:
+    def __init__(self, links, block_submitter):
+        self.links = set(links)
+        self.block_submitter = block_submitter
+        # held while sending to the workers, so they all see the same order
+        self.lock = threading.Lock()
+        self.longpollid = None
+        # previous block hash of the last template sent
+        self.tip = None
+
+    def broadcast(self, *msg):
+        data = json.dumps(msg).encode()
+        for link in list(self.links):
+            try:
+                link.send_data(data)
+            except (IOError, OSError):
+                # serve_worker notices it has gone
+                pass
+
+    # Same interface as Manager.push_template
+    def push_template(self, template, source="longpoll"):
+        with self.lock:
+            if template is None:
+                self.tip = self.longpollid = None
+            elif self.tip is not None and template.get("longpollid") == self.longpollid:
+                return
+            else:
+                self.tip = template["previousblockhash"]
+                self.longpollid = template.get("longpollid")
+            self.broadcast("template", template, source)
+
+    # Same interface as Manager.new_block.  Each worker's manager drops its
+    # work on the old tip itself.
+    def new_block(self, block_hash):
+        with self.lock:
+            self.broadcast("block", block_hash)
+            return block_hash != self.tip
+
+    def serve_worker(self, link):
+        while True:
+            try:
+                msg = link.recv()
+            except (EOFError, IOError, OSError):
+                break
+            if msg[0] == "submit":
+                candidate_id = msg[1]
+                def callback(result, candidate_id=candidate_id):
+                    try:
+                        link.send("result", candidate_id, result)
+                    except (IOError, OSError):
+                        pass
+                self.block_submitter.submit(msg[2], callback)
+        self.links.discard(link)
+        print("%s: lost a worker process, %d left" % (time.asctime(), len(self.links)))
+
+    def start(self):
+        for link in self.links:
+            thread = threading.Thread(target=self.serve_worker, args=(link,))
+            thread.daemon = True
+            thread.start()
+
+# Body of worker process index of count.  listener and stratum_listener are
+# shared with the other workers if the platform lacks SO_REUSEPORT, otherwise
+# None.
+def run_worker(index, count, conn, inherited, listener, stratum_listener):
+    # Interrupting the pool stops the coordinator, which takes the workers
+    # with it.  Without the coordinator's ends of the other workers' pipes,
+    # this worker sees its own pipe close when the coordinator goes.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for other in inherited:
+        other.close()
+    link = Link(conn)
+
+    size = 2**30 // count
+    manager = Manager(config.get("cbscript"), config.get("empty_work"), (index * size, (index + 1) * size))
+    block_submitter = RemoteSubmitter(link)
+
+    def receive():
+        while True:
+            try:
+                msg = link.recv()
+            except (EOFError, IOError, OSError):
+                os._exit(1)
+            if msg[0] == "template":
+                manager.push_template(msg[1], msg[2])
+            elif msg[0] == "block":
+                manager.new_block(msg[1])
+            elif msg[0] == "result":
+                block_submitter.finish(msg[1], msg[2])
+    thread = threading.Thread(target=receive)
+    thread.daemon = True
+    thread.start()
+
+    if listener is None:
+        listener = listen(config.get("listen_port"), True)
+    if stratum_listener is None and config.get("stratum_port"):
+        stratum_listener = listen(config.get("stratum_port"), True)
+    metrics_port = config.get("metrics_port")
+    serve_miners(manager, block_submitter, listener, stratum_listener,
+                 metrics_port and metrics_port + 1 + index, index << 24)
+
+# Fork the workers.  This must happen before any threads are started.  Returns
+# the processes and the coordinator's links to them.
+def start_workers(count):
+    if hasattr(multiprocessing, "get_context"):
+        context = multiprocessing.get_context("fork")
+    else:
+        context = multiprocessing
+    listener = stratum_listener = None
+    if not hasattr(socket, "SO_REUSEPORT"):
+        # the workers all accept from the same sockets instead
+        listener = listen(config.get("listen_port"))
+        if config.get("stratum_port"):
+            stratum_listener = listen(config.get("stratum_port"))
+    pipes = [context.Pipe() for i in range(count)]
+    processes = []
+    for index in range(count):
+        child_conn = pipes[index][1]
+        inherited = [conn for pipe in pipes for conn in pipe if conn is not child_conn]
+        process = context.Process(target=run_worker, args=(index, count, child_conn, inherited, listener, stratum_listener))
+        process.daemon = True
+        process.start()
+        processes.append(process)
+    for conn, child_conn in pipes:
+        child_conn.close()
+    return processes, [Link(conn) for conn, child_conn in pipes]
+
+if __name__ == "__main__":
+    if config.get("workers"):
+        processes, links = start_workers(config.get("workers"))
+        if config.get("record"):
+            recorder.start(config.get("record"))
+        coordinator = Coordinator(links, submitter.Submitter(config.get("journal")))
+        coordinator.start()
+        if config.get("metrics_port"):
+            metrics.serve(config.get("bind_addr"), config.get("metrics_port"))
+        follow_node(coordinator)
+        # os._exit because the template threads never finish
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            for process in processes:
+                process.terminate()
+            os._exit(0)
+        print("%s: all worker processes have stopped" % time.asctime())
+        os._exit(1)
+
+    listener = listen(config.get("listen_port"))
+    stratum_listener = listen(config.get("stratum_port")) if config.get("stratum_port") else None
 
+    if config.get("record"):
+        recorder.start(config.get("record"))
+    manager = Manager(config.get("cbscript"), config.get("empty_work"))
+    block_submitter = submitter.Submitter(config.get("journal"))
+    follow_node(manager)
+    serve_miners(manager, block_submitter, listener, stratum_listener, config.get("metrics_port"))
@@ -0,0 +1,83 @@
+# Copyright (C) 2019 MentalCollatz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Recording of the traffic between the pool and whatever is upstream of it,
+# for replaying with test/replay.py.  A recording is a gzip file of json
+# lines, each [time, kind, payload]:
+#
+#   rpc        {"method": ..., "result": ...} or {"method": ..., "error": ...}
+#   hashblock  new tip hash from the node's zmq notifications
+#   stratum    a message from the upstream stratum server
+#
+# Records are serialized by a background thread, so that recording a large
+# template doesn't hold up the thread that fetched it, and flushed one at a
+# time so that a recording cut short by the process being killed can still
+# be read up to its last record.  Payloads must not be modified once recorded.
+
+import gzip
+import json
+import threading
+import time
+import zlib
+from collections import deque
+
+# the active recorder, if any
+recorder = None
+
+class Recorder:
+    def __init__(self, path):
+        self.file = gzip.open(path, "wb")
+        self.queue = deque()
+        self.cond = threading.Condition()
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def record(self, kind, payload):
+        with self.cond:
+            self.queue.append([time.time(), kind, payload])
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait()
+                entry = self.queue.popleft()
+            self.file.write((json.dumps(entry, separators=(",", ":")) + "\n").encode())
+            self.file.flush()
+
+# Start recording to path
+def start(path):
+    global recorder
+    recorder = Recorder(path)
+
+def record(kind, payload):
+    if recorder is not None:
+        recorder.record(kind, payload)
+
+# Yields the records of a recording as (time, kind, payload), stopping quietly
+# at a truncated end
+def read(path):
+    with gzip.open(path, "rb") as f:
+        try:
+            for line in f:
+                try:
+                    entry = json.loads(line.decode())
+                except ValueError:
+                    return
+                yield tuple(entry)
+        except (EOFError, IOError, zlib.error):
+            return
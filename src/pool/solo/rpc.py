@@ -17,6 +17,11 @@ import requests
 import json
 
 import config
+import metrics
+import recorder
+
+RPC_SECONDS = metrics.Histogram("pool_rpc_seconds", "Duration of rpc calls to the node.", ["method"])
+RPC_ERRORS = metrics.Counter("pool_rpc_errors_total", "Rpc calls that returned an error.", ["method"])
 
 class RpcError(Exception):
     def __init__(self, **kwargs):
@@ -24,6 +29,20 @@ class RpcError(Exception):
         self.errno = kwargs["code"]
 
 def json_request(method, *params):
+    try:
+        with RPC_SECONDS.time(method=method):
+            result = _json_request(method, *params)
+    except RpcError as e:
+        RPC_ERRORS.inc(method=method)
+        recorder.record("rpc", {"method": method, "error": {"code": e.errno, "message": e.strerror}})
+        raise
+    except IOError:
+        RPC_ERRORS.inc(method=method)
+        raise
+    recorder.record("rpc", {"method": method, "result": result})
+    return result
+
+def _json_request(method, *params):
     jdata = {"method": method, "params": params}
     headers = {"Content-Type": "application/json", "Authorization": config.get("rpc_auth")}
     response = requests.post(config.get("rpc_url"), headers=headers, json=jdata)
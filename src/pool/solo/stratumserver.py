@@ -0,0 +1,293 @@
+# Copyright (C) 2019 MentalCollatz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Stratum server for the solo pool.  Instead of a finished header per miner
+# and refresh, clients get coinbase1, coinbase2 and the merkle branch once per
+# template and roll extranonce2 themselves, so the work done per template
+# doesn't grow with the number of clients.  The stratum proxy is such a client.
+#
+# The server is registered with the Manager as if it were a single miner, and
+# only does anything when the template changes.  It isn't counted in the
+# miner metrics, pool_stratum_clients counts its clients instead.
+
+import itertools
+import json
+import socket
+import struct
+import threading
+import time
+from binascii import hexlify, unhexlify
+from struct import pack
+
+import connection
+import metrics
+from template import as_str
+
+EXTRA_NONCE1_SIZE = 4
+EXTRA_NONCE2_SIZE = 4
+# difficulty 1 target, as used by the stratum proxy
+DIFF1_TARGET = 0xffff0000 * 2**192
+# seconds between refresh checks, new templates are pushed immediately anyway
+REFRESH_INTERVAL = 60
+# what json strings decode to, in both Python 2 and 3
+JSON_STR = type(u"")
+
+STRATUM_CLIENTS = metrics.Gauge("pool_stratum_clients", "Connected stratum clients.")
+STRATUM_JOB_SECONDS = metrics.Histogram("pool_stratum_job_seconds", "Time to build and queue a stratum job for all clients.")
+STRATUM_SUBMITS = metrics.Counter("pool_stratum_submit_total", "Stratum submissions by result.", ["result"])
+
+def to_json(obj):
+    return (json.dumps(obj) + "\n").encode()
+
+# Stratum sends the previous block hash with the bytes of each 32 bit word
+# reversed
+def stratum_prevhash(previous_block_hash):
+    return as_str(hexlify(b''.join(previous_block_hash[i:i+4][::-1] for i in range(0, 32, 4))))
+
+# A job refers to its template by id, the server holding a reference to the
+# template in the manager's registry while the job can produce a block.
+class Job:
+    def __init__(self, job_id, template, clean):
+        self.job_id = job_id
+        self.template_id = template.template_id
+        self.previous_block_hash = template.previous_block_hash
+        self.work_per_share = template.work_per_share
+        coinbase1, coinbase2 = template.coinbase.split(EXTRA_NONCE1_SIZE + EXTRA_NONCE2_SIZE)
+        self.params = [
+            job_id,
+            stratum_prevhash(template.previous_block_hash),
+            as_str(hexlify(coinbase1)),
+            as_str(hexlify(coinbase2)),
+            [as_str(hexlify(h)) for h in template.merkle_branch],
+            "%08x" % template.version,
+            as_str(hexlify(template.bits[::-1])),
+            "%08x" % template.time,
+            clean,
+        ]
+        self.notify = to_json({"id": None, "method": "mining.notify", "params": self.params, "odokey": template.odo_key})
+        self.difficulty = float(DIFF1_TARGET) / (int(template.target, 16) + 1)
+
+    # Hex header and block data for a solution, or None if it is malformed
+    def solution(self, template, extra_nonce1, extra_nonce2, ntime, nonce):
+        try:
+            extra_nonce = extra_nonce1 + unhexlify(extra_nonce2)
+            ntime = pack('<I', int(ntime, 16))
+            nonce = pack('<I', int(nonce, 16))
+        except (TypeError, ValueError, struct.error):
+            return None
+        if len(extra_nonce) != EXTRA_NONCE1_SIZE + EXTRA_NONCE2_SIZE:
+            return None
+        work = template.get_work(extra_nonce)
+        header = work[0:136] + as_str(hexlify(ntime)) + work[144:152] + as_str(hexlify(nonce))
+        return header + template.get_data(extra_nonce)
+
+class StratumServer(threading.Thread):
+    def __init__(self, listener, manager, submitter, extra_nonce1_start=0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.listener = listener
+        self.manager = manager
+        self.templates = manager.templates
+        self.submitter = submitter
+        self.peer = "stratum"
+        self.stats = {}
+        self.next_refresh = 0
+        self.lock = threading.Lock()
+        self.clients = set()
+        self.extra_nonces1 = itertools.count(extra_nonce1_start)
+        self.job_ids = itertools.count()
+        # job id -> job, for jobs that can still produce a block
+        self.jobs = {}
+        self.job = None
+        manager.add_miner(self)
+
+    def refresh_interval(self):
+        return REFRESH_INTERVAL
+
+    def hashrate(self):
+        with self.lock:
+            clients = list(self.clients)
+        return sum(client.hashrate() for client in clients)
+
+    # Called by the manager.  Work only changes with the template, so the
+    # extra nonce is not used.
+    def push_work(self, template, extra_nonce, due=None):
+        with self.lock:
+            if self.job is not None and template is not None and template.template_id == self.job.template_id:
+                return
+            if template is None:
+                # Losing the node doesn't make the jobs stale.  They are kept,
+                # and cleared once a template on a new tip arrives.
+                return
+            if self.manager.stale_template(template):
+                # a block has been announced, the template for it is coming
+                return
+            if not self.templates.acquire(template.template_id):
+                # already replaced, and the new one is on its way
+                return
+            start = time.time()
+            clean = self.job is None or self.job.previous_block_hash != template.previous_block_hash
+            if clean:
+                self.clear_jobs()
+            job = Job("%x" % next(self.job_ids), template, clean)
+            self.jobs[job.job_id] = job
+            self.job = job
+            clients = list(self.clients)
+        for client in clients:
+            client.send_job(job)
+        STRATUM_JOB_SECONDS.observe(time.time() - start)
+
+    # Release the templates of the jobs.  Must be called with the lock held.
+    def clear_jobs(self):
+        for job in self.jobs.values():
+            self.templates.release(job.template_id)
+        self.jobs = {}
+
+    # Forget jobs, which can no longer produce a block
+    def drop_work(self):
+        with self.lock:
+            self.clear_jobs()
+
+    # Template for a job, or None if it can no longer produce a block
+    def job_template(self, job):
+        return self.templates.get(job.template_id)
+
+    def get_job(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def current_job(self):
+        with self.lock:
+            return self.job
+
+    def add_client(self, client):
+        with self.lock:
+            self.clients.add(client)
+
+    def remove_client(self, client):
+        with self.lock:
+            self.clients.discard(client)
+
+    def client_count(self):
+        return len(self.clients)
+
+    def run(self):
+        while True:
+            try:
+                conn, addr = self.listener.accept()
+            except socket.error as e:
+                # e.g. out of file descriptors, don't spin until some are freed
+                print("%s: stratum accept failed: %s (errno %s)" % (time.asctime(), e.strerror or e, e.errno))
+                time.sleep(1)
+                continue
+            StratumClient(conn, addr, self, pack('>I', next(self.extra_nonces1) & 0xffffffff))
+
+class StratumClient(threading.Thread):
+    def __init__(self, conn, addr, server, extra_nonce1):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.conn = conn
+        self.server = server
+        self.extra_nonce1 = extra_nonce1
+        # from accept, getpeername fails if the client has already reset
+        self.peer = "%s:%d" % addr[0:2]
+        self.connected = time.time()
+        self.subscribed = False
+        self.difficulty = None
+        self.accepted_work = 0
+        self.outbox = connection.Outbox(conn)
+        server.add_client(self)
+        self.start()
+
+    def hashrate(self):
+        return self.accepted_work / max(1.0, time.time() - self.connected)
+
+    def send(self, data):
+        self.outbox.put(data)
+
+    def send_job(self, job):
+        if not self.subscribed:
+            return
+        if job.difficulty != self.difficulty:
+            self.difficulty = job.difficulty
+            self.send(to_json({"id": None, "method": "mining.set_difficulty", "params": [job.difficulty]}))
+        self.send(job.notify)
+
+    # Queue a solution, answering the request once the node has judged it
+    def submit(self, msg_id, params):
+        job = self.server.get_job(params[1])
+        template = self.server.job_template(job) if job is not None else None
+        if template is None:
+            self.submitted(msg_id, None, "stale")
+            return
+        submit_data = job.solution(template, self.extra_nonce1, *params[2:5])
+        if submit_data is None:
+            self.submitted(msg_id, None, "invalid")
+            return
+        self.server.submitter.submit(submit_data, lambda result: self.submitted(msg_id, job, result))
+
+    def submitted(self, msg_id, job, result):
+        STRATUM_SUBMITS.inc(result=result)
+        if result == "accepted":
+            self.accepted_work += job.work_per_share
+            self.send(to_json({"id": msg_id, "error": None, "result": True}))
+        else:
+            reason = "Stale" if result.startswith("stale") else result
+            self.send(to_json({"id": msg_id, "error": [21 if reason == "Stale" else 20, reason, None],
+                "result": False, "reject-reason": reason}))
+
+    def handle(self, request):
+        method, params, msg_id = request.get("method"), request.get("params") or [], request.get("id")
+        if method == "mining.subscribe":
+            self.send(to_json({"id": msg_id, "error": None, "result": [
+                [["mining.notify", "%08x" % id(self)]], as_str(hexlify(self.extra_nonce1)), EXTRA_NONCE2_SIZE]}))
+            self.subscribed = True
+            job = self.server.current_job()
+            if job is not None:
+                self.send_job(job)
+        elif method == "mining.authorize":
+            # every share pays the pool's address, so anyone may mine
+            self.send(to_json({"id": msg_id, "error": None, "result": True}))
+        elif method == "mining.submit" and isinstance(params, list) and len(params) >= 5:
+            # job id, extra nonce 2, ntime and nonce
+            if all(isinstance(param, JSON_STR) for param in params[1:5]):
+                self.submit(msg_id, params)
+            else:
+                self.submitted(msg_id, None, "invalid")
+        else:
+            self.send(to_json({"id": msg_id, "error": [20, "Unsupported method", None], "result": None}))
+
+    def run(self):
+        self.outbox.start()
+        reader = self.conn.makefile("rb")
+        try:
+            while True:
+                try:
+                    data = reader.readline()
+                    if not data:
+                        break
+                    if not data.strip():
+                        continue
+                    self.handle(json.loads(as_str(data)))
+                except (ValueError, AttributeError):
+                    print("%s: bad stratum request from %s" % (time.asctime(), self.peer))
+                    break
+                except socket.error as e:
+                    break
+        finally:
+            self.server.remove_client(self)
+            self.outbox.close()
+            reader.close()
+            self.conn.close()
@@ -0,0 +1,180 @@
+# Copyright (C) 2019 MentalCollatz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Block submission off the miners' threads.  Candidates are queued, written
+# to an optional journal and submitted by worker threads, which retry with
+# backoff while the node can't be reached or is still starting up.  Other
+# errors are final.  Candidates still unresolved when the pool stops are
+# submitted again from the journal when it next starts.
+
+import heapq
+import itertools
+import json
+import os
+import socket
+import threading
+import time
+
+import metrics
+import rpc
+
+RETRY_INITIAL_DELAY = 1
+RETRY_MAX_DELAY = 30
+# after this long the block has almost certainly been orphaned
+RETRY_TIMEOUT = 600
+# rpc error code for a node that is still loading
+RPC_IN_WARMUP = -28
+
+SUBMIT_QUEUE = metrics.Gauge("pool_submit_queue", "Block candidates waiting to be submitted, including retries.")
+SUBMIT_RETRIES = metrics.Counter("pool_submit_retries_total", "Submissions retried after an rpc error.")
+SUBMIT_SECONDS = metrics.Histogram("pool_submit_seconds", "Time from a candidate being queued to the node's verdict.")
+
+# Append-only record of candidates and their results, one json object per
+# line.  Writes go straight to the operating system, and are fsynced in
+# batches by sync(), which the submitter calls before each submission.
+class Journal:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.file = None
+
+    # Candidates without a result, as (id, time, data).  The journal is
+    # rewritten to hold only these.
+    def load(self):
+        pending = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # torn write at the end
+                        continue
+                    if "data" in record:
+                        pending[record["id"]] = (record["id"], record["time"], record["data"])
+                    else:
+                        pending.pop(record["id"], None)
+        res = sorted(pending.values())
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            for candidate_id, queued, data in res:
+                f.write(json.dumps({"id": candidate_id, "time": queued, "data": data}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.path)
+        self.file = open(self.path, "a")
+        return res
+
+    def append(self, record):
+        with self.lock:
+            self.file.write(json.dumps(record) + "\n")
+            self.file.flush()
+            self.dirty = True
+
+    def sync(self):
+        with self.lock:
+            if self.dirty:
+                os.fsync(self.file.fileno())
+                self.dirty = False
+
+# Whether a failed submission may succeed if tried again.  Rpc errors with a
+# positive code are http statuses without a json body.
+def retryable(e):
+    if not isinstance(e, rpc.RpcError):
+        return True
+    return e.errno == RPC_IN_WARMUP or (isinstance(e.errno, int) and 500 <= e.errno < 600)
+
+class Candidate:
+    def __init__(self, candidate_id, data, callback, queued=None):
+        self.id = candidate_id
+        self.data = data
+        self.callback = callback
+        self.queued = queued or time.time()
+        self.delay = RETRY_INITIAL_DELAY
+
+class Submitter:
+    def __init__(self, journal_path=None, threads=4):
+        self.journal = Journal(journal_path) if journal_path else None
+        self.cond = threading.Condition()
+        # heap of (due time, id, candidate)
+        self.queue = []
+        self.ids = itertools.count()
+        replay = self.journal.load() if self.journal else []
+        if replay:
+            self.ids = itertools.count(replay[-1][0] + 1)
+            print("%s: resubmitting %d block candidates from the journal" % (time.asctime(), len(replay)))
+        for candidate_id, queued, data in replay:
+            self.queue.append((0, candidate_id, Candidate(candidate_id, data, None, queued)))
+        heapq.heapify(self.queue)
+        SUBMIT_QUEUE.set_function(lambda: len(self.queue))
+        for i in range(threads):
+            thread = threading.Thread(target=self.run)
+            thread.daemon = True
+            thread.start()
+
+    # Queue a block for submission.  callback is called with the node's
+    # verdict from a submitter thread, or "error" if it can't be submitted.
+    def submit(self, data, callback):
+        with self.cond:
+            candidate = Candidate(next(self.ids), data, callback)
+            if self.journal:
+                self.journal.append({"id": candidate.id, "time": candidate.queued, "data": data})
+            heapq.heappush(self.queue, (0, candidate.id, candidate))
+            self.cond.notify()
+
+    def next_candidate(self):
+        with self.cond:
+            while True:
+                now = time.time()
+                if self.queue and self.queue[0][0] <= now:
+                    return heapq.heappop(self.queue)[2]
+                self.cond.wait(self.queue[0][0] - now if self.queue else None)
+
+    def finish(self, candidate, result):
+        if self.journal:
+            self.journal.append({"id": candidate.id, "result": result})
+        SUBMIT_SECONDS.observe(time.time() - candidate.queued)
+        if candidate.callback is None:
+            print("%s: journalled block candidate %d: %s" % (time.asctime(), candidate.id, result))
+        else:
+            candidate.callback(result)
+
+    def run(self):
+        while True:
+            candidate = self.next_candidate()
+            if self.journal:
+                self.journal.sync()
+            try:
+                result = rpc.submit_work(candidate.data)
+            except (rpc.RpcError, socket.error) as e:
+                if not retryable(e):
+                    print("%s: block candidate %d failed: %s (errno %s)" % (time.asctime(), candidate.id, e.strerror or e, e.errno))
+                    self.finish(candidate, "error")
+                    continue
+                if time.time() - candidate.queued >= RETRY_TIMEOUT:
+                    # resolved in the journal too, or every restart would try
+                    # it once more and give up again
+                    print("%s: giving up on block candidate %d: %s (errno %s)" % (time.asctime(), candidate.id, e.strerror or e, e.errno))
+                    self.finish(candidate, "error")
+                    continue
+                print("%s: failed to submit, retrying in %ds: %s (errno %s)" % (time.asctime(), candidate.delay, e.strerror or e, e.errno))
+                SUBMIT_RETRIES.inc()
+                with self.cond:
+                    heapq.heappush(self.queue, (time.time() + candidate.delay, candidate.id, candidate))
+                    self.cond.notify()
+                candidate.delay = min(RETRY_MAX_DELAY, candidate.delay * 2)
+                continue
+            self.finish(candidate, result)
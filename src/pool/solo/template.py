@@ -20,6 +20,7 @@ from binascii import hexlify, unhexlify
 from hashlib import sha256
 from segwit_addr import decode as segwit_decode
 from struct import pack
+import sys
 
 def sha256d(data):
     return sha256(sha256(data).digest()).digest()
@@ -175,7 +176,11 @@ class Script:
 
         return None
 
-class Coinbase:
+# Coinbase and BlockTemplate use __slots__ (which needs new-style classes in
+# python 2) to keep the many templates a busy pool holds on to small.
+class Coinbase(object):
+    __slots__ = ("height", "txout", "needs_witness", "coinbaseaux")
+
     def __init__(self, cbscript, template):
         self.height = template["height"]
         self.txout = rewards_for_miners(template["coinbasevalue"], cbscript)
@@ -184,13 +189,16 @@ class Coinbase:
             self.txout.append((0, unhexlify(template["default_witness_commitment"])))
         self.coinbaseaux = template.get("coinbaseaux", {})
 
+    # extra_nonce is either an integer, or bytes pushed as they are
     def _data(self, extra_nonce, extended):
         if not self.needs_witness:
             extended = False
 
-        script_sig = Script()\
-            .push_int(self.height)\
-            .push_int(extra_nonce, False)
+        script_sig = Script().push_int(self.height)
+        if isinstance(extra_nonce, bytes):
+            script_sig.push_str(extra_nonce)
+        else:
+            script_sig.push_int(extra_nonce, False)
         for aux in self.coinbaseaux.values():
             if aux:
                 script_sig.push_str(aux.encode())
@@ -219,10 +227,21 @@ class Coinbase:
     def data(self, extra_nonce):
         return self._data(extra_nonce, True)
 
+    # Split the non-witness serialization around an extra nonce of the given
+    # size, as stratum's coinbase1 and coinbase2
+    def split(self, extra_nonce_size):
+        data = self._data(b'\0' * extra_nonce_size, False)
+        # version, txin count, prevout, script length, height, push length
+        start = 4 + 1 + 36 + 1 + len(Script().push_int(self.height).data) + 1
+        return data[:start], data[start + extra_nonce_size:]
+
     def txid(self, extra_nonce):
         return sha256d(self._data(extra_nonce, False))
 
-class BlockTemplate:
+class BlockTemplate(object):
+    __slots__ = ("version", "previous_block_hash", "merkle_branch", "time", "bits", "coinbase", "txdata",
+                 "target", "work_per_share", "odo_key", "tx_count", "template_id")
+
     def __init__(self, template, cbscript):
         self.version = template["version"]
         self.previous_block_hash = unhexlify(template["previousblockhash"])[::-1]
@@ -233,8 +252,11 @@ class BlockTemplate:
         self.coinbase = Coinbase(cbscript, template)
         self.txdata = "".join(tx["data"] for tx in template["transactions"])
         self.target = template["target"]
+        self.work_per_share = 2**256 // (int(self.target, 16) + 1)
         self.odo_key = template["odokey"]
         self.tx_count = len(template["transactions"]) + 1
+        # set by the registry that keeps the template
+        self.template_id = None
 
     def get_work(self, extra_nonce):
         data = pack('<I', self.version)
@@ -245,6 +267,11 @@ class BlockTemplate:
         data += b'\0\0\0\0' # nonce
         return as_str(hexlify(data))
 
+    # Approximate bytes held, dominated by the transaction data
+    def footprint(self):
+        return sys.getsizeof(self.txdata) + sum(sys.getsizeof(h) for h in self.merkle_branch) + \
+            sum(sys.getsizeof(script) for value, script in self.coinbase.txout)
+
     def get_data(self, extra_nonce):
         cb = self.coinbase.data(extra_nonce)
         return as_str(hexlify(compact_size(self.tx_count) + cb)) + self.txdata
@@ -21,7 +21,7 @@ from hashlib import sha256
 from struct import pack
 
 sys.path.append("../solo/")
-from template import sha256d, merkle_root, merkle_branch, serialize_int
+from template import sha256d, merkle_root, merkle_branch, serialize_int, as_str
 
 def swap_order(d, wsz=8, gsz=1 ):
     return "".join(["".join([m[i:i+gsz] for i in range(wsz-gsz,-gsz,-gsz)]) for m in [d[i:i+wsz] for i in range(0,len(d),wsz)]])
@@ -62,10 +62,10 @@ def get_params_header(params, enonce1, nonce2, nonce2len):
     data += unhexlify(bits)[::-1]
     data += b'\0\0\0\0' # nonce
 
-    return str(hexlify(data))
+    return as_str(hexlify(data))
 
 def n2hex(nonce2, nonce2len):
-    nonce2str = hexlify(serialize_int(nonce2))
+    nonce2str = as_str(hexlify(serialize_int(nonce2)))
     nonce2hex = '0'* ((nonce2len*2)-len(nonce2str)) + nonce2str
     return nonce2hex
 
@@ -18,12 +18,19 @@ import sys
 import json
 import re
 import random
+import struct
+from collections import OrderedDict
 
 import header
+import connection
+import framing
+import metrics
+import recorder
 
 from twisted.internet import defer
 from twisted.internet import protocol
 from twisted.internet import reactor
+from twisted.internet import task
 from twisted.python import log
 
 conncounter = 0
@@ -39,6 +46,18 @@ def toJson(obj):
 def fromJson(str):
     return json.loads(str.decode('utf-8'))
 
+# Miner result for a share the pool rejected, from the reject reason or the
+# conventional stratum error codes (21 job not found, 22 duplicate share)
+def rejectResult(data):
+    reason = str(data.get('reject-reason') or '')
+    error = data.get('error')
+    code = error[0] if isinstance(error, list) and error else None
+    if reason == "Stale" or code == 21:
+        return "result stale"
+    if "duplicate" in reason.lower() or code == 22:
+        return "result duplicate"
+    return "result inconclusive"
+
 class ProxyClientProtocol(protocol.Protocol):
     def connectionMade(self):
         global conncounter
@@ -46,6 +65,8 @@ class ProxyClientProtocol(protocol.Protocol):
         self.conn_id = conncounter
         conncounter += 1
         log.msg("Conn[%d]: connected to peer" % self.conn_id)
+        # jobs from an earlier session can't be submitted to this one
+        self.factory.live_jobs.clear()
         self.cli_queue = self.factory.cli_queue
         self.cli_queue.get().addCallback(self.serverDataReceived)
         # subscribe after connect
@@ -82,6 +103,7 @@ class ProxyClientProtocol(protocol.Protocol):
         for val in curstr:
             try:
                 data = fromJson(val)
+                recorder.record("stratum", data)
                 if data.has_key('method'):
                     if data.get('method') == 'mining.set_difficulty':
                         self.cli_diff = float(data.get('params')[0])
@@ -98,6 +120,7 @@ class ProxyClientProtocol(protocol.Protocol):
                             if jobshow:
                                 log.msg("Stratum: new job %s received, previous block hash %s" % (self.cli_jobid, self.cli_prevblockhash))
                             self.cli_wbclean = data.get('params')[8]
+                            self.factory.addJob(str(self.cli_jobid), self.cli_wbclean)
                             if self.cli_wbclean and extra_nonce > 0:
                                 extra_nonce = 0
                             else:
@@ -126,10 +149,7 @@ class ProxyClientProtocol(protocol.Protocol):
                     else:
                         modifiedchunk = val   # send unmodified content
                 elif data.has_key('reject-reason'):
-                         if str(data.get('reject-reason')) == "Stale":
-                             modifiedchunk = "result stale"
-                         else:
-                             modifiedchunk = "result inconclusive"
+                         modifiedchunk = rejectResult(data)
                 elif data.has_key('result'):
                     if data.get('result') == True and data.get('id') == 1:
                          modifiedchunk = "authorized"
@@ -167,20 +187,58 @@ class ProxyClientFactory(protocol.ReconnectingClientFactory):
     def __init__(self, srv_queue, cli_queue):
         self.srv_queue = srv_queue
         self.cli_queue = cli_queue
+        # job ids the pool still accepts shares for, oldest first
+        self.live_jobs = OrderedDict()
+
+    def addJob(self, job_id, clean):
+        if clean:
+            self.live_jobs.clear()
+        self.live_jobs[job_id] = True
+        while len(self.live_jobs) > MAX_LIVE_JOBS:
+            self.live_jobs.popitem(last=False)
+
+# work ids remembered per connection for binary submissions
+MAX_WORK_IDS = 256
+# jobs and submissions remembered per connection for filtering submissions
+MAX_LIVE_JOBS = 64
+MAX_SUBMITTED = 1024
+
+BOARD_STATS = metrics.Gauge("proxy_board_stat", "Latest statistics reported by each mining board.", ["miner", "stat"])
+FILTERED_SUBMITS = metrics.Counter("proxy_filtered_submits_total", "Submissions answered by the proxy instead of being sent to the pool.", ["reason"])
 
 class ProxyServer(protocol.Protocol):
     global verbose
     global useworkers
+    # latest stats line from each connected miner
+    board_stats = {}
+
     def connectionMade(self):
+        peer = self.transport.getPeer()
+        self.board = "%s:%d" % (peer.host, peer.port)
+        self.buffer = ''
+        self.binary = False
+        # whether work frames carry the header in the order the fpga takes it
+        self.fpga_order = False
+        self.frames = framing.FrameBuffer()
+        # work id -> (idstring, ntime, nonce2) for binary framing
+        self.jobs = {}
+        self.next_work_id = 0
+        self.last_work = None
         self.srv_queue = defer.DeferredQueue()
         self.cli_queue = defer.DeferredQueue()
         self.srv_queue.get().addCallback(self.clientDataReceived)
+        # (job, nonce2, ntime, nonce) of recent submissions, oldest first
+        self.submitted = OrderedDict()
 
-        factory = ProxyClientFactory(self.srv_queue, self.cli_queue)
+        self.client_factory = ProxyClientFactory(self.srv_queue, self.cli_queue)
         log.msg("Stratum: connect to %s:%s" % (self.stratumHost, self.stratumPort))
-        reactor.connectTCP(self.stratumHost, self.stratumPort, factory)
+        reactor.connectTCP(self.stratumHost, self.stratumPort, self.client_factory)
 
     def clientDataReceived(self, chunk):
+        if self.binary:
+            chunk = ''.join(self.encodeLine(line) for line in chunk.splitlines())
+        else:
+            self.last_work = ([line for line in chunk.splitlines() if line.startswith("work ")] or [self.last_work])[-1]
         if verbose:
             log.msg("Server: writing %d bytes to original client" % len(chunk))
         self.transport.write(chunk)
@@ -188,6 +246,7 @@ class ProxyServer(protocol.Protocol):
 
     def doAuth(self, chunk):
         match_obj = re.match(r'auth\s(.+)', chunk)
+        self.board = match_obj.group(1)
         if useworkers:
             self.cli_authid = ''.join([ProxyServer.stratumUser, "_", match_obj.group(1)])
         else:
@@ -199,15 +258,124 @@ class ProxyServer(protocol.Protocol):
         log.msg("Stratum: authorised as %s with password %s" % (self.cli_authid, self.stratumPass))
         return modifiedchunk
 
+    # Board statistics are kept by the proxy rather than forwarded upstream
+    def doStats(self, chunk):
+        ProxyServer.board_stats[self] = connection.parse_stats(chunk.split()[1:])
+        if verbose:
+            log.msg("Server: %s %s" % (self.board, chunk))
+
+    @classmethod
+    def allBoardStats(cls):
+        return [({"miner": conn.board, "stat": key}, value)
+                for conn, stats in list(cls.board_stats.items()) for key, value in stats.items()]
+
+    @classmethod
+    def logBoardStats(cls):
+        boards = list(cls.board_stats.values())
+        if boards:
+            hashrate = sum(stats.get("hashrate", 0) for stats in boards)
+            log.msg("Stats: %d boards reporting, total hashrate %.2f MH/s" % (len(boards), hashrate / 1e6))
+        filtered = FILTERED_SUBMITS.snapshot()
+        if filtered:
+            log.msg("Stats: submissions not sent to the pool: %s" % ", ".join("%s %d" % (key[0], value) for key, value in filtered))
+
+    # Answer a submission without involving the pool
+    def rejectLocally(self, reason):
+        FILTERED_SUBMITS.inc(reason=reason)
+        if self.binary:
+            self.transport.write(framing.encode_text("result %s" % reason))
+        else:
+            self.transport.write("result %s\n" % reason)
+
+    # Reason not to send a submission to the pool, or None if it should be
+    def filterSubmit(self, job_id, ntime, nonce2, nonce):
+        if job_id not in self.client_factory.live_jobs:
+            return "stale"
+        share = (job_id, nonce2.lower(), ntime.lower(), nonce.lower())
+        if share in self.submitted:
+            return "duplicate"
+        self.submitted[share] = True
+        if len(self.submitted) > MAX_SUBMITTED:
+            self.submitted.popitem(last=False)
+        return None
+
+    # Binary framing replaces the stratum job fields of work with a work id
+    def encodeLine(self, line):
+        parts = line.split()
+        if len(parts) == 7 and parts[0] == "work":
+            work_id = self.next_work_id
+            self.next_work_id = (work_id + 1) & 0xffffffff
+            self.jobs[work_id] = parts[4:7]
+            self.jobs.pop((work_id - MAX_WORK_IDS) & 0xffffffff, None)
+            return framing.encode_work(work_id, parts[1], parts[2], int(parts[3]), self.fpga_order)
+        return framing.encode_text(line)
+
+    def protocolError(self, e):
+        log.msg("Server: protocol error from %s: %s" % (self.board, e))
+        self.transport.loseConnection()
+
+    def frameReceived(self, frame_type, payload):
+        if frame_type == framing.FRAME_SUBMIT:
+            try:
+                work_id, nonce = framing.decode_submit(payload)
+            except ValueError as e:
+                self.protocolError(e)
+                return
+            job = self.jobs.get(work_id)
+            if job is None:
+                self.rejectLocally("stale")
+                return
+            # stratum wants the nonce as a number, the frame has it in header order
+            nonce = "%08x" % struct.unpack("<I", nonce)
+            self.lineReceived("submit_nonce %s %s %s %s" % ((nonce,) + tuple(job)))
+        elif frame_type == framing.FRAME_TEXT:
+            self.lineReceived(payload)
+        else:
+            log.msg("Server: unknown frame type %d from client" % frame_type)
+
     def dataReceived(self, chunk):
         if verbose:
             log.msg("Server: %d bytes received" % len(chunk))
+        self.buffer += chunk
+        while not self.binary and '\n' in self.buffer:
+            line, self.buffer = self.buffer.split('\n', 1)
+            self.lineReceived(line.rstrip('\r'))
+        if self.binary:
+            try:
+                frames = self.frames.feed(self.buffer)
+            except ValueError as e:
+                self.protocolError(e)
+                return
+            self.buffer = ''
+            for frame_type, payload in frames:
+                self.frameReceived(frame_type, payload)
+
+    def lineReceived(self, chunk):
         try:
+            if re.match(r'stats\s', chunk):
+                self.doStats(chunk)
+                return
+            if chunk == framing.NEGOTIATE and not self.binary:
+                # nothing is waiting in srv_queue, so this is ordered correctly.
+                # Work already sent as text has no id, so send it again.
+                self.transport.write(chunk + '\n')
+                self.binary = True
+                if self.last_work is not None:
+                    self.transport.write(self.encodeLine(self.last_work))
+                return
+            if chunk == framing.WORK_ORDER_FPGA and self.binary:
+                self.transport.write(framing.encode_text(chunk))
+                self.fpga_order = True
+                return
             if re.match(r'auth\s(.+)', chunk):
                 self.cli_jsonid = 1
                 modifiedchunk = self.doAuth(chunk)
             elif re.match(r'submit_nonce', chunk):
                 match_obj = re.match(r'submit_nonce\s(\w+)\s(\w+)\s(\w+)\s(\w+)', chunk)
+                reason = self.filterSubmit(match_obj.group(2), match_obj.group(3), match_obj.group(4), match_obj.group(1))
+                if reason is not None:
+                    self.rejectLocally(reason)
+                    return
                 params = [self.cli_authid, str(match_obj.group(2)), match_obj.group(4), str(match_obj.group(3)), str(match_obj.group(1))]
                 modifiedchunk = toJson({'id':self.cli_jsonid, 'method':'mining.submit','params':params})
                 self.cli_jsonid += 1
@@ -219,6 +387,7 @@ class ProxyServer(protocol.Protocol):
             log.msg("Server: unknown data from client %s" % chunk)
 
     def connectionLost(self, why):
+        ProxyServer.board_stats.pop(self, None)
         self.cli_queue.put(False)
 
 if __name__ == "__main__":
@@ -236,6 +405,8 @@ if __name__ == "__main__":
     parser.add_argument("-t", "--testnet", help="use testnet", action="store_true")
     parser.add_argument("-j", "--jobshow", help="show new job", action="store_true")
     parser.add_argument("--listen", metavar="port", help="listen tcp port", type=int, choices=range(1,65535), default=17065)
+    parser.add_argument("-m", "--metrics", metavar="port", help="port to serve metrics on", type=int)
+    parser.add_argument("--record", metavar="file", help="record messages from the stratum server to this file, for test/replay.py")
 
     arguments = vars(parser.parse_args())
     log.startLogging(sys.stdout)
@@ -253,6 +424,13 @@ if __name__ == "__main__":
     if testnet:
         log.msg("Working in a testnet mode")
 
+    BOARD_STATS.set_function(ProxyServer.allBoardStats)
+    if arguments["record"]:
+        recorder.start(arguments["record"])
+    if arguments["metrics"]:
+        metrics.serve("127.0.0.1", arguments["metrics"])
+    task.LoopingCall(ProxyServer.logBoardStats).start(60, now=False)
+
     log.startLogging(sys.stdout)
     factory = protocol.Factory()
     factory.protocol = ProxyServer
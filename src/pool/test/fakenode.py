@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+
+# Mock DigiByte node for testing.  Serves getblocktemplate and submitblock.
+# Copyright (C) 2019 MentalCollatz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import json
+import random
+import struct
+import threading
+import time
+from binascii import hexlify, unhexlify
+from hashlib import sha256
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+TESTNET_RPC_PORT = 14023
+TESTNET_EPOCH_LENGTH = 86400
+LONGPOLL_TIMEOUT = 60
+
+def sha256d(data):
+    return sha256(sha256(data).digest()).digest()
+
+def hex_str(b):
+    res = hexlify(b)
+    if type(res) == bytes:
+        res = res.decode()
+    return res
+
+def random_bytes(rng, n):
+    return bytes(bytearray(rng.getrandbits(8) for i in range(n)))
+
+# Generate a fake transaction.  The data is not a valid transaction, but the
+# pool only ever treats it as an opaque blob.
+def make_tx(rng, segwit, size=250):
+    data = random_bytes(rng, size)
+    txid = sha256d(data)[::-1]
+    wtxid = sha256d(data + b'\0')[::-1] if segwit else txid
+    return {
+        "data": hex_str(data),
+        "txid": hex_str(txid),
+        "hash": hex_str(wtxid),
+        "fee": rng.randrange(1000, 100000),
+    }
+
+# Build a getblocktemplate response.  Segwit templates include a witness
+# commitment and transactions whose hash differs from their txid.
+def make_template(height, prevhash, n_tx=0, segwit=True, curtime=None, rng=None,
+                  target="00000fffff000000000000000000000000000000000000000000000000000000"):
+    if rng is None:
+        rng = random.Random(height)
+    if curtime is None:
+        curtime = int(time.time())
+    transactions = [make_tx(rng, segwit) for i in range(n_tx)]
+    template = {
+        "version": 0x20000202,
+        "previousblockhash": prevhash,
+        "transactions": transactions,
+        "coinbaseaux": {"flags": ""},
+        "coinbasevalue": 72000000000 + sum(tx["fee"] for tx in transactions),
+        "longpollid": "%s%d" % (prevhash, height),
+        "target": target,
+        "curtime": curtime,
+        "bits": "1e0fffff",
+        "height": height,
+        "odokey": curtime - curtime % TESTNET_EPOCH_LENGTH,
+    }
+    if segwit:
+        template["default_witness_commitment"] = "6a24aa21a9ed" + hex_str(random_bytes(rng, 32))
+    return template
+
+class FakeNode:
+    def __init__(self, n_tx=0, segwit=True, block_interval=15, seed=None, longpoll_delay=0):
+        self.n_tx = n_tx
+        self.segwit = segwit
+        self.block_interval = block_interval
+        # seconds a longpoll keeps waiting after a new block, like a busy node
+        self.longpoll_delay = longpoll_delay
+        self.rng = random.Random(seed)
+        self.cond = threading.Condition()
+        self.height = 1000
+        self.template = None
+        self.block_time = None
+        self.submitted = 0
+        self.listeners = []
+        self.new_block()
+
+    # Advance the tip and notify anyone waiting on a longpoll
+    def new_block(self):
+        with self.cond:
+            self.height += 1
+            prevhash = hex_str(random_bytes(self.rng, 32))
+            self.template = make_template(self.height, prevhash, self.n_tx, self.segwit, rng=self.rng)
+            self.block_time = time.time()
+            self.cond.notify_all()
+        for listener in self.listeners:
+            listener(prevhash, self.block_time)
+
+    def get_block_template(self, params=None, *args):
+        longpollid = (params or {}).get("longpollid")
+        with self.cond:
+            if longpollid != self.template["longpollid"]:
+                return self.template
+            self.cond.wait(LONGPOLL_TIMEOUT)
+            template = self.template
+        if self.longpoll_delay and template["longpollid"] != longpollid:
+            time.sleep(self.longpoll_delay)
+        return template
+
+    def submit_block(self, data, *args):
+        with self.cond:
+            self.submitted += 1
+        return None
+
+    def dispatch(self, method, params):
+        if method == "getblocktemplate":
+            return self.get_block_template(*params)
+        elif method == "submitblock":
+            return self.submit_block(*params)
+        raise KeyError(method)
+
+    def run(self):
+        while True:
+            if self.block_interval > 0:
+                time.sleep(self.rng.expovariate(1.0 / self.block_interval))
+                self.new_block()
+            else:
+                time.sleep(1000)
+
+# Raised by a node's dispatch to answer with an rpc error
+class RpcFault(Exception):
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
+        self.message = message
+
+class RpcHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])).decode())
+        try:
+            response = {"result": self.server.node.dispatch(request["method"], request["params"]), "error": None}
+        except KeyError as e:
+            response = {"result": None, "error": {"code": -32601, "message": "Method not found"}}
+        except RpcFault as e:
+            response = {"result": None, "error": {"code": e.code, "message": e.message}}
+        body = json.dumps(response).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class RpcServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    # clients abandoning a longpoll are expected, don't spam tracebacks
+    def handle_error(self, request, client_address):
+        pass
+
+# Publish new block hashes like a node run with -zmqpubhashblock
+def publish_blocks(node, port, bind_addr="127.0.0.1"):
+    import zmq
+    sock = zmq.Context.instance().socket(zmq.PUB)
+    sock.bind("tcp://%s:%d" % (bind_addr, port))
+    sequence = [0]
+    def publish(prevhash, block_time):
+        sock.send_multipart([b"hashblock", unhexlify(prevhash), struct.pack("<I", sequence[0])])
+        sequence[0] += 1
+    node.listeners.append(publish)
+
+# Start serving the node over JSON-RPC in background threads
+def serve(node, port, bind_addr="localhost"):
+    server = RpcServer((bind_addr, port), RpcHandler)
+    server.node = node
+    for target in [server.serve_forever, node.run]:
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+    return server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock node serving getblocktemplate and submitblock.")
+    parser.add_argument("-p", "--port", help="rpc port", type=int, default=TESTNET_RPC_PORT)
+    parser.add_argument("-n", "--txs", help="transactions per template", type=int, default=0)
+    parser.add_argument("--no-segwit", help="generate non-segwit templates", dest="segwit", action="store_false")
+    parser.add_argument("-b", "--block-interval", help="mean seconds between blocks (0 to disable)", type=float, default=15)
+    parser.add_argument("-s", "--seed", help="random seed", type=int)
+    parser.add_argument("-z", "--zmq-port", help="publish hashblock notifications on this port", type=int)
+    parser.add_argument("--longpoll-delay", help="seconds longpolls lag behind new blocks", type=float, default=0)
+    args = parser.parse_args()
+
+    def announce(prevhash, block_time):
+        print("%s: new block %s" % (time.asctime(), prevhash))
+
+    node = FakeNode(args.txs, args.segwit, args.block_interval, args.seed, args.longpoll_delay)
+    node.listeners.append(announce)
+    if args.zmq_port:
+        publish_blocks(node, args.zmq_port)
+    serve(node, args.port)
+    print("serving on port %d" % args.port)
+    while True:
+        time.sleep(1000)
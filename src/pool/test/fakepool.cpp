@@ -226,6 +226,10 @@ void FakePool(int conn, int epochLength)
                 if (!SendStr(conn, workBuf))
                     break;
             }
+            else if (command.substr(0, 6) == "stats ")
+            {
+                printf("%s\n", command.c_str());
+            }
             else
             {
                 fprintf(stderr, "Unknown command: %s\n", command.c_str());
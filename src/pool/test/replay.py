@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+
+# Replay a recording made with --record by the solo pool or stratum proxy.
+# Copyright (C) 2019 MentalCollatz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Recorded templates and block notifications are served by a stand-in node,
+# and recorded stratum jobs by a stand-in stratum server, at the times they
+# were recorded divided by the speed factor.  Submissions are answered with
+# the recorded verdicts in order, whatever is submitted.
+
+import argparse
+import json
+import socket
+import sys
+import threading
+import time
+from collections import deque
+
+import fakenode
+
+sys.path.append("../solo/")
+import recorder
+
+DEFAULT_STRATUM_PORT = 3333
+# used if the recording doesn't include the subscribe response
+DEFAULT_SUBSCRIBE_RESULT = [[["mining.notify", "1"]], "00000000", 4]
+
+# Records of a recording as (offset, kind, payload), with offsets in seconds
+# from the first record
+def load(path):
+    records = list(recorder.read(path))
+    if not records:
+        return []
+    start = records[0][0]
+    return [(t - start, kind, payload) for t, kind, payload in records]
+
+# Recording time, running speed times faster than real time
+class Clock:
+    def __init__(self, speed=1.0):
+        self.start = time.time()
+        self.speed = speed
+
+    def wait_until(self, offset):
+        delay = self.start + offset / self.speed - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+# Stand-in node.  It has the same interface as fakenode.FakeNode, so it can be
+# served with fakenode.serve and publish_blocks.
+class ReplayNode:
+    def __init__(self, records, clock):
+        self.clock = clock
+        self.cond = threading.Condition()
+        self.listeners = []
+        self.template = None
+        self.block_time = None
+        self.submitted = 0
+        # tip most recently announced to the listeners
+        self.announced = None
+        # (offset, template), leaving out templates the pool fetched twice
+        self.templates = []
+        # (offset, block hash) from zmq notifications
+        self.blocks = []
+        self.submit_results = deque()
+        for offset, kind, payload in records:
+            if kind == "rpc" and payload["method"] == "getblocktemplate" and "result" in payload:
+                template = payload["result"]
+                if not self.templates or self.templates[-1][1]["longpollid"] != template["longpollid"]:
+                    self.templates.append((offset, template))
+            elif kind == "rpc" and payload["method"] == "submitblock":
+                self.submit_results.append(payload)
+            elif kind == "hashblock":
+                self.blocks.append((offset, payload))
+        if not self.templates:
+            raise ValueError("recording has no templates")
+        self.next_template = 1
+        self.set_template(self.templates[0][1])
+
+    def set_template(self, template):
+        with self.cond:
+            new_tip = self.template is None or self.template["previousblockhash"] != template["previousblockhash"]
+            self.template = template
+            if new_tip:
+                self.block_time = time.time()
+            self.cond.notify_all()
+        if new_tip:
+            self.announce(template["previousblockhash"])
+
+    # Tell the listeners about a new tip, once
+    def announce(self, block_hash):
+        if block_hash == self.announced:
+            return
+        self.announced = block_hash
+        for listener in self.listeners:
+            listener(block_hash, time.time())
+
+    # Serve the templates up to and including index
+    def advance(self, index):
+        while self.next_template <= index:
+            self.set_template(self.templates[self.next_template][1])
+            self.next_template += 1
+
+    # A block notification means the node already had the template for it,
+    # which the recording only shows once the pool fetched it.
+    def new_block(self, block_hash):
+        for index in range(self.next_template, len(self.templates)):
+            if self.templates[index][1]["previousblockhash"] == block_hash:
+                self.advance(index)
+                break
+        self.announce(block_hash)
+
+    def get_block_template(self, params=None, *args):
+        longpollid = (params or {}).get("longpollid")
+        with self.cond:
+            if longpollid != self.template["longpollid"]:
+                return self.template
+            self.cond.wait(fakenode.LONGPOLL_TIMEOUT)
+            return self.template
+
+    def submit_block(self, data, *args):
+        with self.cond:
+            self.submitted += 1
+            result = self.submit_results.popleft() if self.submit_results else {"result": None}
+        if "error" in result:
+            raise fakenode.RpcFault(result["error"]["code"], result["error"]["message"])
+        return result["result"]
+
+    def dispatch(self, method, params):
+        if method == "getblocktemplate":
+            return self.get_block_template(*params)
+        elif method == "submitblock":
+            return self.submit_block(*params)
+        raise KeyError(method)
+
+    def run(self):
+        events = [(offset, 0, index) for index, (offset, template) in enumerate(self.templates)][1:]
+        events += [(offset, 1, block_hash) for offset, block_hash in self.blocks]
+        for offset, is_block, value in sorted(events):
+            self.clock.wait_until(offset)
+            if is_block:
+                self.new_block(value)
+            else:
+                self.advance(value)
+        print("%s: node replay finished" % time.asctime())
+        sys.stdout.flush()
+        while True:
+            time.sleep(1000)
+
+# Stand-in stratum server.  Every client gets the recorded jobs.
+class ReplayStratum:
+    def __init__(self, records, clock):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.clients = set()
+        # (offset, message) for mining.notify, mining.set_difficulty etc.
+        self.broadcasts = []
+        self.subscribe_result = None
+        self.submit_results = deque()
+        # latest of each, for clients that subscribe part way through
+        self.difficulty = None
+        self.notify = None
+        # The proxy subscribes with id 0 and authorizes with id 1, so other
+        # responses are to submissions.
+        for offset, kind, msg in records:
+            if kind != "stratum":
+                continue
+            if msg.get("method") is not None:
+                self.broadcasts.append((offset, msg))
+            elif msg.get("id") == 0:
+                if self.subscribe_result is None:
+                    self.subscribe_result = msg.get("result")
+            elif msg.get("id") != 1:
+                self.submit_results.append(msg)
+        if not self.broadcasts:
+            raise ValueError("recording has no stratum jobs")
+        self.subscribe_result = self.subscribe_result or DEFAULT_SUBSCRIBE_RESULT
+
+    def broadcast(self, msg):
+        with self.lock:
+            if msg["method"] == "mining.set_difficulty":
+                self.difficulty = msg
+            elif msg["method"] == "mining.notify":
+                self.notify = msg
+            clients = list(self.clients)
+        for client in clients:
+            client.send(msg)
+
+    def next_submit_result(self, msg_id):
+        with self.lock:
+            res = dict(self.submit_results.popleft()) if self.submit_results else {"result": True, "error": None}
+        res["id"] = msg_id
+        return res
+
+    def subscribed(self, client):
+        with self.lock:
+            self.clients.add(client)
+            current = [msg for msg in [self.difficulty, self.notify] if msg is not None]
+        for msg in current:
+            client.send(msg)
+
+    def remove_client(self, client):
+        with self.lock:
+            self.clients.discard(client)
+
+    def run(self):
+        for offset, msg in self.broadcasts:
+            self.clock.wait_until(offset)
+            self.broadcast(msg)
+        print("%s: stratum replay finished" % time.asctime())
+        sys.stdout.flush()
+
+    def serve(self, port, bind_addr="localhost"):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((bind_addr, port))
+        listener.listen(socket.SOMAXCONN)
+        def accept():
+            while True:
+                conn, addr = listener.accept()
+                ReplayStratumClient(conn, self).start()
+        for target in [accept, self.run]:
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+class ReplayStratumClient(threading.Thread):
+    def __init__(self, conn, server):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.conn = conn
+        self.server = server
+        self.lock = threading.Lock()
+
+    def send(self, msg):
+        try:
+            with self.lock:
+                self.conn.sendall((json.dumps(msg) + "\n").encode())
+        except socket.error:
+            pass
+
+    def handle(self, request):
+        method, msg_id = request.get("method"), request.get("id")
+        if method == "mining.subscribe":
+            self.send({"id": msg_id, "result": self.server.subscribe_result, "error": None})
+            self.server.subscribed(self)
+        elif method == "mining.authorize":
+            self.send({"id": msg_id, "result": True, "error": None})
+        elif method == "mining.submit":
+            self.send(self.server.next_submit_result(msg_id))
+        else:
+            self.send({"id": msg_id, "result": None, "error": [20, "Unsupported method", None]})
+
+    def run(self):
+        reader = self.conn.makefile("rb")
+        try:
+            for line in reader:
+                if line.strip():
+                    self.handle(json.loads(line.decode()))
+        except (ValueError, socket.error):
+            pass
+        self.server.remove_client(self)
+        self.conn.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a pool or stratum proxy recording back through a stand-in node or stratum server.")
+    parser.add_argument("recording", help="file written by --record")
+    parser.add_argument("--speed", help="replay this many times faster than recorded", type=float, default=1.0)
+    parser.add_argument("-p", "--port", help="rpc port for the stand-in node", type=int, default=fakenode.TESTNET_RPC_PORT)
+    parser.add_argument("-z", "--zmq-port", help="publish hashblock notifications on this port", type=int)
+    parser.add_argument("-s", "--stratum-port", help="port for the stand-in stratum server", type=int, default=DEFAULT_STRATUM_PORT)
+    args = parser.parse_args()
+
+    records = load(args.recording)
+    clock = Clock(args.speed)
+    kinds = set(kind for offset, kind, payload in records)
+    if "rpc" in kinds:
+        node = ReplayNode(records, clock)
+        if args.zmq_port:
+            fakenode.publish_blocks(node, args.zmq_port)
+        fakenode.serve(node, args.port)
+        print("replaying %d templates and %d block notifications on port %d" % (len(node.templates), len(node.blocks), args.port))
+    if "stratum" in kinds:
+        stratum = ReplayStratum(records, clock)
+        stratum.serve(args.stratum_port)
+        print("replaying %d stratum messages on port %d" % (len(stratum.broadcasts), args.stratum_port))
+    if not kinds & set(["rpc", "stratum"]):
+        parser.error("nothing to replay in %s" % args.recording)
+    sys.stdout.flush()
+    while True:
+        time.sleep(1000)
@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+
+# Simulated miner swarm for load testing the solo pool and stratum proxy.
+# Copyright (C) 2019 MentalCollatz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import errno
+import heapq
+import json
+import random
+import select
+import socket
+import sys
+import time
+from binascii import hexlify, unhexlify
+from collections import deque
+
+import fakenode
+import replay
+
+sys.path.append("../solo/")
+import framing
+
+DEFAULT_SOLO_PORT = 17064
+DEFAULT_STRATUM_PORT = 17065
+# results the solo pool answers a submission with straight away.  "pending"
+# is followed by the node's verdict once the block has been submitted.
+IMMEDIATE_RESULTS = ("pending", "stale")
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+
+def summarize(values):
+    res = {"count": len(values)}
+    for p in [50, 90, 99]:
+        res["p%d" % p] = percentile(values, p)
+    res["max"] = max(values) if values else None
+    return res
+
+def fmt_ms(value):
+    if value is None:
+        return "-"
+    return "%.1fms" % (value * 1000)
+
+class Stats:
+    def __init__(self):
+        self.started = time.time()
+        self.work_latency = []
+        self.submit_rtt = []
+        # latencies since the last report, and one summary per report
+        self.interval_latency = []
+        self.interval_rtt = []
+        self.steps = []
+        self.results = {}
+        self.works = 0
+        self.submits = 0
+        self.disconnects = 0
+        # time each previous block hash was first published or seen
+        self.block_seen = {}
+
+    def block_time(self, prevhash, now):
+        return self.block_seen.setdefault(prevhash, now)
+
+    def add_work_latency(self, latency):
+        self.work_latency.append(latency)
+        self.interval_latency.append(latency)
+
+    def add_submit_rtt(self, rtt):
+        self.submit_rtt.append(rtt)
+        self.interval_rtt.append(rtt)
+
+    def end_interval(self, connected):
+        step = {
+            "connected": connected,
+            "work_latency": summarize(self.interval_latency),
+            "submit_rtt": summarize(self.interval_rtt),
+        }
+        self.steps.append(step)
+        self.interval_latency = []
+        self.interval_rtt = []
+        return step
+
+    # final results, not counting the pool's "pending" acknowledgements
+    def result_count(self):
+        return sum(count for result, count in self.results.items() if result != "pending")
+
+    def stale_rate(self):
+        total = self.result_count()
+        return float(self.results.get("stale", 0)) / total if total else 0.0
+
+    def summary(self, connected):
+        elapsed = time.time() - self.started
+        return {
+            "elapsed": elapsed,
+            "connected": connected,
+            "works": self.works,
+            "submits": self.submits,
+            "results": self.results,
+            "disconnects": self.disconnects,
+            "stale_rate": self.stale_rate(),
+            "submit_throughput": self.submits / elapsed,
+            "result_throughput": self.result_count() / elapsed,
+            "work_latency": summarize(self.work_latency),
+            "submit_rtt": summarize(self.submit_rtt),
+            "steps": self.steps,
+        }
+
+class SimMiner:
+    def __init__(self, index, sock, args):
+        self.index = index
+        self.sock = sock
+        self.args = args
+        self.inbuf = b''
+        self.outbuf = b''
+        self.work = None
+        self.prevhash = None
+        # send times of submissions not answered yet, and of those answered
+        # "pending" whose final result is still to come
+        self.sent_times = deque()
+        self.pending_times = deque()
+        self.binary = False
+        self.frames = framing.FrameBuffer()
+        self.work_id = None
+
+    def send(self, line):
+        if self.binary:
+            self.send_data(framing.encode_text(line))
+        else:
+            self.send_data((line + "\n").encode())
+
+    def send_data(self, data):
+        self.outbuf += data
+        self.flush()
+
+    def flush(self):
+        try:
+            while self.outbuf:
+                sent = self.sock.send(self.outbuf)
+                self.outbuf = self.outbuf[sent:]
+        except socket.error as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def lines(self):
+        data = self.sock.recv(4096)
+        if not data:
+            raise EOFError()
+        self.inbuf += data
+        # handle() may switch to binary framing part way through
+        while not self.binary and b'\n' in self.inbuf:
+            line, self.inbuf = self.inbuf.split(b'\n', 1)
+            yield line.decode().strip()
+        if self.binary:
+            frames = self.frames.feed(self.inbuf)
+            self.inbuf = b''
+            for frame_type, payload in frames:
+                if frame_type == framing.FRAME_WORK:
+                    self.work_id, header, target, key = framing.decode_work(payload)
+                    yield "work %s %s %d" % (header, target, key)
+                elif frame_type == framing.FRAME_TEXT:
+                    yield payload.decode()
+
+    def submit(self, stats, now):
+        if self.work is None or self.work[0] == "0" * 64:
+            return
+        nonce = random.getrandbits(32)
+        if self.binary and self.work_id is not None:
+            self.send_data(framing.encode_submit(self.work_id, unhexlify("%08x" % nonce)))
+        elif len(self.work) == 6:
+            idstring, ntime, nonce2 = self.work[3:6]
+            self.send("submit_nonce %08x %s %s %s" % (nonce, idstring, ntime, nonce2))
+        else:
+            self.send("submit %s%08x" % (self.work[0][0:152], nonce))
+        self.sent_times.append(now)
+        stats.submits += 1
+
+    def handle(self, line, stats, now):
+        parts = line.split()
+        if not parts:
+            return
+        command, args = parts[0], parts[1:]
+        if command == "work" and len(args) in (3, 6):
+            self.work = args
+            stats.works += 1
+            prevhash = args[0][8:72]
+            if prevhash != self.prevhash and prevhash != "0" * 64:
+                # the first work after connecting says nothing about latency
+                if self.prevhash is not None:
+                    stats.add_work_latency(now - stats.block_time(prevhash, now))
+                self.prevhash = prevhash
+        elif command == "result" and args:
+            stats.results[args[0]] = stats.results.get(args[0], 0) + 1
+            # The round trip is to the final result.  Immediate answers come
+            # in submission order, with the final results of pending
+            # submissions mixed in.  The stratum proxy never says "pending".
+            if args[0] in IMMEDIATE_RESULTS or not self.pending_times:
+                sent = self.sent_times.popleft() if self.sent_times else None
+            else:
+                sent = self.pending_times.popleft()
+            if sent is None:
+                return
+            if args[0] == "pending":
+                self.pending_times.append(sent)
+            else:
+                stats.add_submit_rtt(now - sent)
+        elif command == "set_subscribe_params":
+            self.send("auth %d" % self.index)
+        elif line == framing.NEGOTIATE:
+            self.binary = True
+
+def connect(args, index):
+    sock = socket.create_connection((args.host, args.port), timeout=10)
+    sock.setblocking(0)
+    miner = SimMiner(index, sock, args)
+    if args.binary:
+        miner.send(framing.NEGOTIATE)
+    return miner
+
+# Print a progress line.  Latencies are for the last interval only, so that
+# the effect of adding miners shows up when ramping.
+def report(stats, connected):
+    step = stats.end_interval(connected)
+    print("%s: miners=%d works=%d submits=%d results=%d stale=%.2f%% work_p50=%s work_p99=%s rtt_p50=%s rtt_p99=%s" % (
+        time.asctime(), connected, stats.works, stats.submits, stats.result_count(), 100 * stats.stale_rate(),
+        fmt_ms(step["work_latency"]["p50"]), fmt_ms(step["work_latency"]["p99"]),
+        fmt_ms(step["submit_rtt"]["p50"]), fmt_ms(step["submit_rtt"]["p99"])))
+    sys.stdout.flush()
+
+def add_miners(args, count, miners, poller, schedule):
+    for i in range(count):
+        try:
+            miner = connect(args, len(miners))
+        except socket.error as e:
+            print("connection %d failed: %s" % (len(miners), e))
+            return False
+        miners[miner.sock.fileno()] = miner
+        poller.register(miner.sock, select.POLLIN)
+        heapq.heappush(schedule, (time.time() + random.expovariate(args.rate), miner.sock.fileno()))
+    return True
+
+def run(args):
+    stats = Stats()
+
+    if args.node_port:
+        if args.replay:
+            node = replay.ReplayNode(replay.load(args.replay), replay.Clock(args.speed))
+        else:
+            node = fakenode.FakeNode(args.txs, not args.no_segwit, args.block_interval, longpoll_delay=args.longpoll_delay)
+        def on_block(prevhash, block_time):
+            stats.block_seen[hexlify(unhexlify(prevhash)[::-1]).decode()] = block_time
+        node.listeners.append(on_block)
+        on_block(node.template["previousblockhash"], node.block_time)
+        fakenode.serve(node, args.node_port)
+        if args.zmq_port:
+            fakenode.publish_blocks(node, args.zmq_port)
+
+    poller = select.poll()
+    miners = {}
+    schedule = []
+    ramping = add_miners(args, args.ramp or args.miners, miners, poller, schedule) and args.ramp > 0
+
+    end_time = time.time() + args.duration
+    next_report = time.time() + args.interval
+    while miners and time.time() < end_time:
+        now = time.time()
+        wakeup = min(end_time, next_report, schedule[0][0] if schedule else end_time)
+        for fd, event in poller.poll(max(0, (wakeup - now) * 1000)):
+            miner = miners.get(fd)
+            if miner is None:
+                continue
+            now = time.time()
+            try:
+                for line in miner.lines():
+                    miner.handle(line, stats, now)
+                miner.flush()
+            except (EOFError, ValueError, socket.error):
+                poller.unregister(fd)
+                miner.sock.close()
+                del miners[fd]
+                stats.disconnects += 1
+        now = time.time()
+        while schedule and schedule[0][0] <= now:
+            due, fd = heapq.heappop(schedule)
+            miner = miners.get(fd)
+            if miner is None:
+                continue
+            try:
+                miner.submit(stats, now)
+            except socket.error:
+                continue
+            heapq.heappush(schedule, (now + random.expovariate(args.rate), fd))
+        if now >= next_report:
+            report(stats, len(miners))
+            if ramping and len(miners) < args.miners:
+                count = min(args.ramp, args.miners - len(miners))
+                ramping = add_miners(args, count, miners, poller, schedule)
+            next_report = time.time() + args.interval
+
+    report(stats, len(miners))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(stats.summary(len(miners)), f, indent=2, sort_keys=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulated miner swarm for load testing pools.")
+    parser.add_argument("-H", "--host", help="pool host", default="localhost")
+    parser.add_argument("-p", "--port", help="pool port", type=int)
+    parser.add_argument("-s", "--stratum", help="expect stratum proxy work messages", action="store_true")
+    parser.add_argument("-n", "--miners", help="number of simulated miners", type=int, default=100)
+    parser.add_argument("--ramp", help="start with this many miners and add as many again every interval", type=int, default=0)
+    parser.add_argument("-b", "--binary", help="negotiate binary framing", action="store_true")
+    parser.add_argument("-r", "--rate", help="shares per second per miner", type=float, default=0.1)
+    parser.add_argument("-d", "--duration", help="test duration in seconds", type=float, default=60)
+    parser.add_argument("-i", "--interval", help="seconds between progress reports", type=float, default=5)
+    parser.add_argument("--json", help="write final summary to this file", type=str)
+    parser.add_argument("--node-port", help="run a mock node on this rpc port", type=int)
+    parser.add_argument("--txs", help="mock node transactions per template", type=int, default=0)
+    parser.add_argument("--no-segwit", help="mock node generates non-segwit templates", action="store_true")
+    parser.add_argument("--block-interval", help="mock node mean seconds between blocks", type=float, default=15)
+    parser.add_argument("--longpoll-delay", help="mock node seconds longpolls lag behind new blocks", type=float, default=0)
+    parser.add_argument("--zmq-port", help="mock node publishes hashblock notifications on this port", type=int)
+    parser.add_argument("--replay", help="mock node replays this recording made with the pool's --record", type=str)
+    parser.add_argument("--speed", help="replay this many times faster than recorded", type=float, default=1.0)
+    args = parser.parse_args()
+    if args.port is None:
+        args.port = DEFAULT_STRATUM_PORT if args.stratum else DEFAULT_SOLO_PORT
+    run(args)